@@ -0,0 +1,278 @@
+"""
+Benchmarks of the API hot paths, on synthetic root folders.
+
+Run with ``make benchmarks`` (results are saved in ``.benchmarks/`` and compared
+with the previous run). The scale can be reduced with environment variables,
+eg. ``BENCHMARK_FOLDERS=1000 make benchmarks``.
+"""
+
+import importlib
+import json
+import os
+import shutil
+import string
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+_PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(_PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(_PROJECT_ROOT))
+
+
+FOLDER_FILES = int(os.getenv("BENCHMARK_FOLDER_FILES", "10000"))
+FOLDERS = int(os.getenv("BENCHMARK_FOLDERS", "50000"))
+# Ratio of folders that are expired when purging.
+EXPIRED_RATIO = 0.01
+ARCHIVE_SIZE_MB = int(os.getenv("BENCHMARK_ARCHIVE_SIZE_MB", "4096"))
+ARCHIVE_FILES = 16
+AUTH_HEADER = {"Authorization": "Bearer s2cr2t"}
+
+
+def folder_name(index):
+    """
+    Folder IDs only contain letters (eg. ``bench-cab-folder``).
+    """
+    letters = ""
+    while True:
+        index, remainder = divmod(index, 26)
+        letters += string.ascii_lowercase[remainder]
+        if index == 0:
+            return f"bench-{letters}-folder"
+
+
+def load_app(monkeypatch, root):
+    monkeypatch.setenv("BESACE_ROOT_FOLDER", str(root))
+    monkeypatch.setenv("BESACE_RETENTION_DAYS", "7")
+    monkeypatch.setenv("BESACE_CREATE_SECRETS", "s2cr2t")
+    # Never build archives in background while measuring.
+    monkeypatch.setenv("BESACE_ARCHIVE_BUILD_DELAY_SECONDS", "3600")
+    import main
+
+    importlib.reload(main)
+    return main
+
+
+def download_archive(client, folder_id):
+    with client.stream("GET", f"/folder/{folder_id}/download") as res:
+        for _ in res.iter_raw():
+            pass
+    return res
+
+
+def make_folders(root, count, created):
+    index = []
+    for i in range(count):
+        folder_id = folder_name(i)
+        (root / folder_id).mkdir()
+        with open(root / f"{folder_id}.meta", "w") as f:
+            json.dump({"created": created}, f)
+        index.append((created, folder_id))
+    return index
+
+
+@pytest.fixture(scope="module")
+def big_folder(tmp_path_factory):
+    root = tmp_path_factory.mktemp("big-folder")
+    folder_id = folder_name(0)
+    folder = root / folder_id
+    folder.mkdir()
+    content = os.urandom(1024)
+    for i in range(FOLDER_FILES):
+        (folder / f"IMG_{i:05d}.jpg").write_bytes(content)
+    return root, folder_id
+
+
+@pytest.fixture(scope="module")
+def many_folders(tmp_path_factory):
+    root = tmp_path_factory.mktemp("many-folders")
+    index = make_folders(root, FOLDERS, created=int(time.time()))
+    return root, index
+
+
+@pytest.fixture(scope="module")
+def large_folder(tmp_path_factory):
+    root = tmp_path_factory.mktemp("large-folder")
+    folder_id = folder_name(0)
+    folder = root / folder_id
+    folder.mkdir()
+    size = ARCHIVE_SIZE_MB * 1024 * 1024 // ARCHIVE_FILES
+    for i in range(ARCHIVE_FILES):
+        with open(folder / f"VID_{i:02d}.mp4", "wb") as f:
+            # Sparse files, the disk only holds the archives.
+            f.truncate(size)
+    return root, folder_id
+
+
+def test_get_folder(benchmark, monkeypatch, big_folder):
+    root, folder_id = big_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+    # Manifest is up to date.
+    client.get(f"/folder/{folder_id}")
+
+    res = benchmark(client.get, f"/folder/{folder_id}")
+
+    assert len(res.json()["files"]) == FOLDER_FILES
+    benchmark.extra_info["files"] = FOLDER_FILES
+
+
+def test_get_folder_page(benchmark, monkeypatch, big_folder):
+    root, folder_id = big_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+    first = client.get(f"/folder/{folder_id}", params={"limit": 100}).json()
+
+    res = benchmark(
+        client.get,
+        f"/folder/{folder_id}",
+        params={"limit": 100, "cursor": first["next_cursor"]},
+    )
+
+    assert len(res.json()["files"]) == 100
+    benchmark.extra_info["files"] = FOLDER_FILES
+
+
+def test_get_folder_ndjson(benchmark, monkeypatch, big_folder):
+    root, folder_id = big_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+
+    res = benchmark(
+        client.get,
+        f"/folder/{folder_id}",
+        headers={"Accept": "application/x-ndjson"},
+    )
+
+    assert len(res.text.splitlines()) == FOLDER_FILES + 1
+    benchmark.extra_info["files"] = FOLDER_FILES
+
+
+def test_get_folder_without_manifest(benchmark, monkeypatch, big_folder):
+    root, folder_id = big_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+
+    def remove_manifest():
+        (root / f"{folder_id}.manifest").unlink(missing_ok=True)
+
+    res = benchmark.pedantic(
+        client.get, args=(f"/folder/{folder_id}",), setup=remove_manifest, rounds=10
+    )
+
+    assert len(res.json()["files"]) == FOLDER_FILES
+    benchmark.extra_info["files"] = FOLDER_FILES
+
+
+def test_get_folder_not_modified(benchmark, monkeypatch, big_folder):
+    root, folder_id = big_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+    etag = client.get(f"/folder/{folder_id}").headers["etag"]
+
+    res = benchmark(client.get, f"/folder/{folder_id}", headers={"If-None-Match": etag})
+
+    assert res.status_code == 304
+
+
+def test_purge_old_folders_without_expired(benchmark, monkeypatch, many_folders):
+    root, index = many_folders
+    main = load_app(monkeypatch, root)
+    main.write_expiry_index(index)
+
+    benchmark(main.purge_old_folders)
+
+    assert all((root / folder_id).exists() for _, folder_id in index[:10])
+    benchmark.extra_info["folders"] = len(index)
+
+
+def test_purge_old_folders(benchmark, monkeypatch, many_folders):
+    root, index = many_folders
+    main = load_app(monkeypatch, root)
+    expired = index[: max(1, int(len(index) * EXPIRED_RATIO))]
+    ten_days_ago = int(time.time()) - 10 * 24 * 3600
+
+    def expire_folders():
+        for _, folder_id in expired:
+            (root / folder_id).mkdir(exist_ok=True)
+        main.write_expiry_index(
+            [(ten_days_ago, folder_id) for _, folder_id in expired]
+            + index[len(expired) :]
+        )
+
+    benchmark.pedantic(main.purge_old_folders, setup=expire_folders, rounds=5)
+
+    assert not (root / expired[0][1]).exists()
+    benchmark.extra_info["folders"] = len(index)
+    benchmark.extra_info["expired"] = len(expired)
+
+
+def test_create_folder(benchmark, monkeypatch, many_folders):
+    root, index = many_folders
+    main = load_app(monkeypatch, root)
+    main.write_expiry_index(index)
+    client = TestClient(main.app, follow_redirects=False)
+
+    res = benchmark(client.post, "/folder", headers=AUTH_HEADER)
+
+    assert res.status_code == 303
+    benchmark.extra_info["folders"] = len(index)
+
+
+def test_get_folder_archive_first_build(benchmark, monkeypatch, large_folder):
+    root, folder_id = large_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+
+    def remove_archive():
+        (root / f"{folder_id}.zip").unlink(missing_ok=True)
+
+    res = benchmark.pedantic(
+        download_archive, args=(client, folder_id), setup=remove_archive, rounds=3
+    )
+
+    assert res.status_code == 200
+    benchmark.extra_info["bytes"] = ARCHIVE_SIZE_MB * 1024 * 1024
+    if benchmark.stats:
+        # Not measured with --benchmark-disable.
+        benchmark.extra_info["MB/s"] = ARCHIVE_SIZE_MB / benchmark.stats.stats.mean
+
+
+@pytest.mark.parametrize("previous", [False, True], ids=["copy", "in_place"])
+def test_get_folder_archive_append(benchmark, monkeypatch, large_folder, previous):
+    root, folder_id = large_folder
+    main = load_app(monkeypatch, root)
+    client = TestClient(main.app)
+    folder = root / folder_id
+    archive = root / f"{folder_id}.zip"
+    # Snapshot without the last file.
+    last_file = sorted(folder.iterdir())[-1]
+    pending = root / last_file.name
+    shutil.move(last_file, pending)
+    (root / f"{folder_id}.manifest").unlink(missing_ok=True)
+    archive.unlink(missing_ok=True)
+    main.update_folder_archive(folder_id)
+    base = root / f"{folder_id}.zip.base"
+    shutil.move(archive, base)
+    shutil.move(pending, last_file)
+    main.load_manifest(folder_id)
+
+    next_archive = root / f"{folder_id}.zip.next"
+
+    def restore_snapshot():
+        shutil.copyfile(base, archive)
+        next_archive.unlink(missing_ok=True)
+        if previous:
+            # Previous snapshot kept by the last update.
+            shutil.copyfile(base, next_archive)
+
+    res = benchmark.pedantic(
+        download_archive, args=(client, folder_id), setup=restore_snapshot, rounds=3
+    )
+
+    assert res.status_code == 200
+    benchmark.extra_info["bytes"] = ARCHIVE_SIZE_MB * 1024 * 1024
+    benchmark.extra_info["appended_bytes"] = last_file.stat().st_size
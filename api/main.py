@@ -1,14 +1,26 @@
 import asyncio
+import base64
+import collections
 import datetime
 import functools
+import hashlib
+import heapq
 import json
+import math
+import mimetypes
 import os
 import random
 import re
 import shutil
+import struct
+import sys
 import tempfile
+import threading
 import time
+import urllib.parse
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Annotated
@@ -22,13 +34,41 @@ from fastapi import (
     Request,
     Security,
     Path as FastAPIPath,
+    Query,
+    Response,
 )
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
-from pydantic import AfterValidator
+import orjson
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from pydantic import AfterValidator, BaseModel
+
+try:
+    # Thumbnails are created on demand if the thumbnailer is installed next to
+    # the API (see ``thumbnailer/``), otherwise only existing ones are served.
+    import thumbnailer
+except ImportError:
+    thumbnailer = None
+else:
+    thumbnailer.register_heif_opener()
 
 HERE = here = Path(__file__).parent
 ROOT_FOLDER = Path(os.getenv("BESACE_ROOT_FOLDER", "."))
+# Optionally spread folders in sub-directories named after the first bytes of
+# the MD5 of their ID (eg. ``3f/a2/ossa-teneas-doctum`` with 2 levels), to keep
+# directories small. Folders of the flat layout are still found, and can be
+# moved with ``python main.py migrate``.
+SHARD_LEVELS = int(os.getenv("BESACE_SHARD_LEVELS", "0"))
+SHARD_PATTERN = re.compile(r"^[0-9a-f]{2}$")
+# Files stored next to each folder.
+FOLDER_SIDECARS = (".meta", ".md5", ".manifest", ".zip")
 RETENTION_DAYS = int(os.getenv("BESACE_RETENTION_DAYS", "10"))
 CREATE_SECRETS = os.getenv("BESACE_CREATE_SECRETS", "s2cr2t,s3cr3t").split(",")
 FOLDER_WORDS_MIN_LENGTH = 3
@@ -38,25 +78,202 @@ BESACE_FOLDER_PATTERN = re.compile(
     f"^([a-zA-Z]+-){{{FOLDER_WORDS_COUNT - 1}}}[a-zA-Z]+$"
 )
 LOG_SECRET_REVEAL_LENGTH = int(os.getenv("BESACE_LOG_SECRET_REVEAL_LENGTH", "3"))
-INVALID_SECRET_WAIT_SECONDS = int(os.getenv("BESACE_INVALID_SECRET_WAIT_SECONDS", "2"))
+# Invalid secrets attempts allowed per client IP and per secret prefix, and
+# delay after which one more attempt is allowed.
+INVALID_SECRET_BURST = int(os.getenv("BESACE_INVALID_SECRET_BURST", "10"))
+INVALID_SECRET_REFILL_SECONDS = float(
+    os.getenv("BESACE_INVALID_SECRET_REFILL_SECONDS", "60")
+)
 LOCK_TIMEOUT_SECONDS = int(os.getenv("BESACE_LOCK_TIMEOUT_SECONDS", "60"))
+# Either "cache" (keep an archive on disk, updated on download) or "stream"
+# (build the archive on the fly while it is being downloaded).
+ARCHIVE_MODE = os.getenv("BESACE_ARCHIVE_MODE", "cache")
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+# Archives are rebuilt in background once uploads have settled for this long.
+ARCHIVE_BUILD_DELAY_SECONDS = float(
+    os.getenv("BESACE_ARCHIVE_BUILD_DELAY_SECONDS", "10")
+)
+ARCHIVE_BUILD_CONCURRENCY = int(os.getenv("BESACE_ARCHIVE_BUILD_CONCURRENCY", "2"))
+# Files are deflated in parallel when archives are built (cache mode).
+ARCHIVE_COMPRESS_WORKERS = int(
+    os.getenv("BESACE_ARCHIVE_COMPRESS_WORKERS", str(os.cpu_count() or 1))
+)
+ARCHIVE_COMPRESS_LEVEL = 6
+# Files deflated in parallel are added with zipfile internals, checked on these
+# Python versions. On others, zipfile compresses them itself (sequentially), and
+# archive updates copy the whole previous snapshot.
+ARCHIVE_PRE_DEFLATED_VERSIONS = ((3, 11), (3, 12), (3, 13))
+# Archives updated in place are rebuilt when this part of their size is taken by
+# the central directories of their previous versions.
+ARCHIVE_MAX_WASTE_RATIO = 0.1
+# Deflated files are kept aside until written in order: only this many files
+# are deflated ahead of the one being written.
+ARCHIVE_COMPRESS_WINDOW = 2 * ARCHIVE_COMPRESS_WORKERS
+# Media and archives are already compressed, and stored as is.
+ARCHIVE_STORED_EXTENSIONS = set(
+    """
+    .jpg .jpeg .png .gif .webp .heic .heif .avif
+    .mp4 .mov .m4v .mkv .webm .avi .3gp
+    .mp3 .m4a .aac .ogg .opus .flac
+    .zip .gz .bz2 .xz .zst .7z .rar
+    .docx .xlsx .pptx .odt .ods .odp .epub
+    """.split()
+)
+# Other files are deflated if a sample of their first bytes shrinks enough.
+ARCHIVE_COMPRESS_SAMPLE_SIZE = 64 * 1024
+ARCHIVE_COMPRESS_MIN_RATIO = 0.9
+# Directory timestamps may be coarse: a manifest written shortly after the last
+# change of its folder is not trusted (like "racy" entries of Git's index).
+MANIFEST_RACY_SECONDS = 2
+PURGE_INTERVAL_SECONDS = float(os.getenv("BESACE_PURGE_INTERVAL_SECONDS", "3600"))
+# Long-polling of folder changes.
+CHANGES_TIMEOUT_SECONDS = float(os.getenv("BESACE_CHANGES_TIMEOUT_SECONDS", "25"))
+CHANGES_POLL_SECONDS = 1
+# Maximum number of files per page of folder listing.
+LIST_LIMIT_MAX = 10000
+# Files are sent by batches when listing is streamed (NDJSON).
+LIST_STREAM_BATCH_SIZE = 500
+# Let the reverse proxy send files: "X-Accel-Redirect" (nginx) or "X-Sendfile"
+# (Apache), followed by the internal location (or path) of the root folder.
+SENDFILE_HEADER = os.getenv("BESACE_SENDFILE_HEADER", "")
+SENDFILE_PREFIX = os.getenv("BESACE_SENDFILE_PREFIX", "/internal-uploads/")
+# Where tusd stores uploads in progress (see `-upload-dir`).
+INCOMING_FOLDER = Path(os.getenv("BESACE_INCOMING_FOLDER", "incoming"))
+# Shared with the thumbnailer, thumbnails are stored by folder name.
+THUMBNAILS_FOLDER = os.getenv("BESACE_THUMBNAILS_FOLDER", "")
+THUMBNAIL_SIZES = (128, 256, 512)
+# Size used by the thumbnailer, other sizes are stored in sub-folders.
+THUMBNAIL_DEFAULT_SIZE = 256
+THUMBNAIL_EXTENSION = ".jpg"
+THUMBNAIL_FRAME_TIME = 1.0
+THUMBNAIL_MAX_AGE_SECONDS = 365 * 24 * 3600
+# Blocking filesystem calls run in two pools of threads, so that heavy jobs
+# (archives, deletions, hashing) cannot starve light ones (listings, metadata).
+FAST_IO_WORKERS = int(os.getenv("BESACE_FAST_IO_WORKERS", "16"))
+BULK_IO_WORKERS = int(os.getenv("BESACE_BULK_IO_WORKERS", "4"))
+# Number of bulk jobs that can wait for a thread before requests are rejected.
+BULK_IO_BACKLOG = int(os.getenv("BESACE_BULK_IO_BACKLOG", "16"))
+BULK_IO_RETRY_AFTER_SECONDS = 5
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+
+metrics_registry = CollectorRegistry()
+requests_total = Counter(
+    "besace_requests_total",
+    "Number of requests per route",
+    ["route", "method", "status"],
+    registry=metrics_registry,
+)
+request_duration = Histogram(
+    "besace_request_duration_seconds",
+    "Time to send the whole response per route",
+    ["route"],
+    registry=metrics_registry,
+)
+response_bytes = Counter(
+    "besace_response_bytes_total",
+    "Bytes sent in responses bodies per route",
+    ["route"],
+    registry=metrics_registry,
+)
+archive_lock_wait = Histogram(
+    "besace_archive_lock_wait_seconds",
+    "Time spent waiting for the lock of a folder archive",
+    registry=metrics_registry,
+)
+archive_lock_timeouts = Counter(
+    "besace_archive_lock_timeouts_total",
+    "Number of times the lock of a folder archive could not be acquired",
+    registry=metrics_registry,
+)
+purge_duration = Histogram(
+    "besace_purge_duration_seconds",
+    "Duration of the purge of old folders",
+    buckets=(0.1, 1, 10, 60, 300, 1800, float("inf")),
+    registry=metrics_registry,
+)
+purged_folders = Counter(
+    "besace_purged_folders_total",
+    "Number of old folders deleted by the purge",
+    registry=metrics_registry,
+)
+# Measured once on startup, and then maintained by the API.
+folders_count = Gauge(
+    "besace_folders",
+    "Number of folders",
+    registry=metrics_registry,
+)
+stored_bytes = Gauge(
+    "besace_stored_bytes",
+    "Total size of the files in folders",
+    registry=metrics_registry,
+)
 
 
 api_secret_header = APIKeyHeader(name="Authorization")
 
 
+def rate_limit(keys, cost=1):
+    """
+    Take ``cost`` tokens from the buckets of ``keys``, and return the number of
+    seconds to wait before the next attempt if one of them is empty (0 otherwise).
+
+    The buckets are shared by workers in a JSON file, where only the buckets that
+    are not full are kept.
+    """
+    buckets_file = ROOT_FOLDER / ".ratelimit"
+    with FileLock(ROOT_FOLDER / ".ratelimit.lock"):
+        try:
+            buckets = orjson.loads(buckets_file.read_bytes())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            buckets = {}
+        now = time.time()
+        refilled = {}
+        for key, (tokens, updated) in buckets.items():
+            tokens += (now - updated) / INVALID_SECRET_REFILL_SECONDS
+            if tokens < INVALID_SECRET_BURST:
+                refilled[key] = tokens
+        levels = [refilled.get(key, INVALID_SECRET_BURST) for key in keys]
+        if min(levels) < 1:
+            return (1 - min(levels)) * INVALID_SECRET_REFILL_SECONDS
+        if not cost:
+            return 0
+        for key, tokens in zip(keys, levels):
+            refilled[key] = tokens - cost
+        buckets_file.write_bytes(
+            orjson.dumps({key: (tokens, now) for key, tokens in refilled.items()})
+        )
+        return 0
+
+
 async def check_api_secret(
+    request: Request,
     api_key_header: str = Security(api_secret_header),
 ) -> str:
     try:
         _type, secret = api_key_header.split(" ", 1)
     except ValueError:
         secret = None
-    if secret in CREATE_SECRETS:
+    client_ip = request.client.host if request.client else "unknown"
+    keys = [f"ip:{client_ip}"]
+    valid = secret in CREATE_SECRETS
+    if secret and not valid:
+        # Slow down guesses of the same secret from many IPs.
+        keys.append(f"secret:{secret[:LOG_SECRET_REVEAL_LENGTH]}")
+    # Even a valid secret is refused once the IP has exhausted its attempts,
+    # otherwise a throttled client could keep guessing and tell the right
+    # secret by the status. The address is set by the reverse proxy.
+    retry_after = await fast_io.run(rate_limit, keys, cost=0 if valid else 1)
+    if retry_after:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many invalid API Secret attempts",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+    if valid:
         print(f"Using secret '{secret[:LOG_SECRET_REVEAL_LENGTH]}..'")
         return secret
-    # Let's slow down retries here...
-    await asyncio.sleep(INVALID_SECRET_WAIT_SECONDS)
     raise HTTPException(
         status_code=401,
         detail="Invalid or missing API Secret",
@@ -83,6 +300,74 @@ Filename = Annotated[
 ]
 
 
+def shard_dir(folder_id) -> Path:
+    if not SHARD_LEVELS:
+        return ROOT_FOLDER
+    digest = hashlib.md5(folder_id.encode()).hexdigest()
+    return ROOT_FOLDER.joinpath(
+        *(digest[2 * i : 2 * i + 2] for i in range(SHARD_LEVELS))
+    )
+
+
+def folder_base(folder_id) -> Path:
+    """
+    Return the directory that contains the folder and its sidecar files.
+    """
+    base = shard_dir(folder_id)
+    if (
+        base != ROOT_FOLDER
+        and not (base / folder_id).exists()
+        and (ROOT_FOLDER / folder_id).exists()
+    ):
+        # Not migrated yet.
+        return ROOT_FOLDER
+    return base
+
+
+def folder_path(folder_id, suffix="") -> Path:
+    """
+    Return the path of the folder, or of one of its sidecar files (eg. ``.meta``).
+    """
+    base = folder_base(folder_id)
+    path = base / f"{folder_id}{suffix}"
+    if suffix and base != ROOT_FOLDER and not path.exists():
+        # Not moved yet (migration in progress).
+        flat = ROOT_FOLDER / f"{folder_id}{suffix}"
+        if flat.exists():
+            return flat
+    return path
+
+
+def folder_lock(folder_id, suffix) -> FileLock:
+    """
+    Lock files always live in the shard directory, so that processes agree on
+    them while the folder is being migrated.
+    """
+    base = shard_dir(folder_id)
+    if base != ROOT_FOLDER:
+        base.mkdir(parents=True, exist_ok=True)
+    return FileLock(base / f"{folder_id}{suffix}")
+
+
+def iter_folders():
+    """
+    Yield the IDs of all folders (in both layouts).
+    """
+
+    def scan(directory, depth):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                if BESACE_FOLDER_PATTERN.match(entry.name):
+                    if depth in (0, SHARD_LEVELS):
+                        yield entry.name
+                elif depth < SHARD_LEVELS and SHARD_PATTERN.match(entry.name):
+                    yield from scan(entry.path, depth + 1)
+
+    yield from scan(ROOT_FOLDER, 0)
+
+
 def startup_check():
     print(f"Using {ROOT_FOLDER!r} as root folder")
     # Test that root is writable.
@@ -91,32 +376,912 @@ def startup_check():
     testfile.close()
 
 
+def measure_storage():
+    """
+    Initialize the storage gauges from the folders manifests.
+    """
+    count = size = 0
+    for folder_id in iter_folders():
+        files = load_manifest(folder_id)["files"]
+        count += 1
+        size += sum(info["size"] for info in files.values())
+    folders_count.set(count)
+    stored_bytes.set(size)
+    print(f"{count} folders, {size} bytes in {ROOT_FOLDER}")
+
+
 def get_folder_metadata(folder_id):
-    metadata_file = ROOT_FOLDER / f"{folder_id}.meta"
-    if not metadata_file.exists():
+    try:
+        with open(folder_path(folder_id, ".meta")) as f:
+            return json.load(f)
+    except FileNotFoundError:
         # Fallback if folder was created with old Besace versions.
-        folder = ROOT_FOLDER / folder_id
         return {
-            "created": folder.stat().st_mtime,
+            "created": folder_path(folder_id).stat().st_mtime,
         }
-    with open(metadata_file) as f:
-        metadata = json.load(f)
-    return metadata
+
+
+def read_manifest(folder_id):
+    """
+    Read the manifest of the folder, without checking whether it is up to date.
+
+    The manifest is a JSON lines file: every line describes a file (or a removed
+    file) with the version of the folder when it was seen, and may carry the
+    modification time of the folder (``dir_mtime``) once the line was written.
+    """
+    manifest = {"version": 0, "files": {}, "removed": {}, "dir_mtime": None}
+    try:
+        with open(folder_path(folder_id, ".manifest")) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Interrupted write.
+                    continue
+                if "dir_mtime" in record:
+                    manifest["dir_mtime"] = max(
+                        manifest["dir_mtime"] or 0, record["dir_mtime"]
+                    )
+                if "filename" not in record:
+                    continue
+                filename = record["filename"]
+                version = record.get("version", 0)
+                manifest["version"] = max(manifest["version"], version)
+                if record.get("removed"):
+                    manifest["files"].pop(filename, None)
+                    manifest["removed"][filename] = version
+                else:
+                    manifest["removed"].pop(filename, None)
+                    manifest["files"][filename] = {
+                        "filename": filename,
+                        "size": record["size"],
+                        "modified": record["modified"],
+                        "version": version,
+                    }
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def write_manifest(folder_id, manifest):
+    dir_mtime = manifest["dir_mtime"]
+    if time.time_ns() - dir_mtime < MANIFEST_RACY_SECONDS * 1_000_000_000:
+        dir_mtime = 0
+    manifest_file = folder_path(folder_id, ".manifest")
+    fd, tmp_path = tempfile.mkstemp(
+        dir=manifest_file.parent, prefix=f".{folder_id}.manifest"
+    )
+    with open(fd, "w") as f:
+        f.write(json.dumps({"dir_mtime": dir_mtime}) + "\n")
+        for info in manifest["files"].values():
+            f.write(json.dumps(info) + "\n")
+        for filename, version in manifest["removed"].items():
+            record = {"filename": filename, "removed": True, "version": version}
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, manifest_file)
+
+
+def load_manifest(folder_id):
+    """
+    Return the manifest of the folder, with its files by filename, the
+    filenames of removed files, and the current version of the folder.
+
+    If the folder was modified since the manifest was written, only the new
+    files are stat'ed and the manifest is rewritten with a new version.
+    """
+    folder_dir = folder_path(folder_id)
+    dir_mtime = folder_dir.stat().st_mtime_ns
+    manifest = read_manifest(folder_id)
+    if manifest["dir_mtime"] == dir_mtime:
+        return manifest
+
+    # Versions must be assigned by one writer at a time.
+    with folder_lock(folder_id, ".manifest.lock"):
+        return refresh_manifest(folder_id)
+
+
+def refresh_manifest(folder_id):
+    folder_dir = folder_path(folder_id)
+    dir_mtime = folder_dir.stat().st_mtime_ns
+    manifest = read_manifest(folder_id)
+    if manifest["dir_mtime"] == dir_mtime:
+        # Refreshed by someone else meanwhile.
+        return manifest
+
+    with os.scandir(folder_dir) as entries:
+        filenames = {entry.name for entry in entries if entry.is_file()}
+    files = manifest["files"]
+    added = filenames - files.keys()
+    removed = files.keys() - filenames
+    if added or removed:
+        manifest["version"] += 1
+    for filename in removed:
+        del files[filename]
+        manifest["removed"][filename] = manifest["version"]
+    for filename in added:
+        stat = (folder_dir / filename).stat()
+        manifest["removed"].pop(filename, None)
+        files[filename] = {
+            "filename": filename,
+            "size": stat.st_size,
+            "modified": stat.st_mtime,
+            "version": manifest["version"],
+        }
+    manifest["dir_mtime"] = dir_mtime
+    write_manifest(folder_id, manifest)
+    return manifest
+
+
+def add_to_manifest(folder_id, filename, dir_mtime_before):
+    """
+    Record a file that was just moved into the folder.
+
+    The manifest is only appended if it was up to date before the move (ie. the
+    folder's mtime before the move), otherwise the folder is rescanned.
+    Must be called with the manifest lock held.
+    """
+    folder_dir = folder_path(folder_id)
+    manifest = read_manifest(folder_id)
+    if manifest["dir_mtime"] != dir_mtime_before:
+        refresh_manifest(folder_id)
+        return
+    stat = (folder_dir / filename).stat()
+    record = {
+        "filename": filename,
+        "size": stat.st_size,
+        "modified": stat.st_mtime,
+        "version": manifest["version"] + 1,
+        "dir_mtime": folder_dir.stat().st_mtime_ns,
+    }
+    with open(folder_path(folder_id, ".manifest"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def read_expiry_index():
+    """
+    Return the list of ``(created, folder_id)`` ordered by creation date.
+
+    The index is a JSON lines file, where folders are appended when created.
+    If missing, it is rebuilt from the folders metadata.
+    """
+    index_file = ROOT_FOLDER / ".expiry"
+    if not index_file.exists():
+        folders = [
+            (get_folder_metadata(folder_id)["created"], folder_id)
+            for folder_id in iter_folders()
+        ]
+        write_expiry_index(folders)
+        return sorted(folders)
+    index = []
+    with open(index_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Interrupted write.
+                continue
+            index.append((record["created"], record["folder"]))
+    return sorted(index)
+
+
+def write_expiry_index(index):
+    fd, tmp_path = tempfile.mkstemp(dir=ROOT_FOLDER, prefix=".expiry")
+    with open(fd, "w") as f:
+        for created, folder_id in index:
+            f.write(json.dumps({"created": created, "folder": folder_id}) + "\n")
+    os.replace(tmp_path, ROOT_FOLDER / ".expiry")
+
+
+def add_to_expiry_index(folder_id, created):
+    with FileLock(ROOT_FOLDER / ".expiry.lock"):
+        if not (ROOT_FOLDER / ".expiry").exists():
+            # Rebuilt from existing folders, including this one.
+            read_expiry_index()
+            return
+        with open(ROOT_FOLDER / ".expiry", "a") as f:
+            f.write(json.dumps({"created": created, "folder": folder_id}) + "\n")
+
+
+def remove_folder(folder_id):
+    """
+    Delete the folder and its artifacts. Return ``False`` if it does not exist.
+
+    Uploads wait for the manifest lock, so that they do not re-create the
+    folder sidecar files.
+    """
+    with folder_lock(folder_id, ".manifest.lock"):
+        folder_dir = folder_path(folder_id)
+        if not os.path.exists(folder_dir):
+            return False
+        with os.scandir(folder_dir) as entries:
+            size = sum(entry.stat().st_size for entry in entries if entry.is_file())
+        shutil.rmtree(folder_dir)
+        folders_count.dec()
+        stored_bytes.dec(size)
+        try:
+            os.remove(folder_path(folder_id, ".zip"))
+        except FileNotFoundError:
+            # Archive was never requested.
+            pass
+        try:
+            os.remove(folder_path(folder_id, ".zip.next"))
+        except FileNotFoundError:
+            # Archive was never updated.
+            pass
+        try:
+            os.remove(folder_path(folder_id, ".zip.previous"))
+        except FileNotFoundError:
+            # No archive update was interrupted.
+            pass
+        try:
+            os.remove(folder_path(folder_id, ".manifest"))
+        except FileNotFoundError:
+            # Folder was never listed.
+            pass
+        try:
+            os.remove(folder_path(folder_id, ".md5"))
+        except FileNotFoundError:
+            # No file added to the folder (md5 happens in hook).
+            pass
+        try:
+            os.remove(folder_path(folder_id, ".meta"))
+        except FileNotFoundError:
+            # Folder was created with older version.
+            pass
+        if THUMBNAILS_FOLDER:
+            # Also deleted by the thumbnailer, if running.
+            shutil.rmtree(Path(THUMBNAILS_FOLDER) / folder_id, ignore_errors=True)
+        with folders_hashes_lock:
+            folders_hashes.pop(folder_id, None)
+    print(f"Deleted folder '{folder_dir}'")
+    return True
+
+
+def migrate_folder(folder_id):
+    """
+    Move a folder of the flat layout, and its sidecar files, to its shard directory.
+    """
+    base = shard_dir(folder_id)
+    # Archives updates, uploads and manifest writes wait for these locks.
+    with folder_lock(folder_id, ".zip.lock"), folder_lock(folder_id, ".manifest.lock"):
+        # From now on, the folder is looked up in its shard directory (and its
+        # sidecar files in both, until they are moved).
+        os.rename(ROOT_FOLDER / folder_id, base / folder_id)
+        for suffix in FOLDER_SIDECARS:
+            try:
+                os.rename(
+                    ROOT_FOLDER / f"{folder_id}{suffix}", base / f"{folder_id}{suffix}"
+                )
+            except FileNotFoundError:
+                pass
+        for suffix in (".zip.next", ".zip.previous", ".zip.lock", ".manifest.lock"):
+            (ROOT_FOLDER / f"{folder_id}{suffix}").unlink(missing_ok=True)
+
+
+def migrate_folders():
+    """
+    Move all folders of the flat layout to the sharded one (``BESACE_SHARD_LEVELS``).
+
+    Folders are moved one at a time, and can be used by the API meanwhile.
+    """
+    if not SHARD_LEVELS:
+        print("Set BESACE_SHARD_LEVELS to migrate folders")
+        return
+    with os.scandir(ROOT_FOLDER) as entries:
+        folder_ids = [
+            entry.name
+            for entry in entries
+            if entry.is_dir() and BESACE_FOLDER_PATTERN.match(entry.name)
+        ]
+    for folder_id in folder_ids:
+        try:
+            migrate_folder(folder_id)
+        except FileNotFoundError:
+            # Deleted in the meantime.
+            continue
+        print(f"Moved folder '{folder_id}' to {shard_dir(folder_id)}")
+    print(f"Migrated {len(folder_ids)} folders in {ROOT_FOLDER}")
 
 
 def purge_old_folders():
-    now = datetime.datetime.today()
-    folders = [
-        (path.name, get_folder_metadata(path.name)["created"])
-        for path in ROOT_FOLDER.iterdir()
-        if path.is_dir()
+    # Only one worker purges at a time (works across containers too).
+    lock = FileLock(ROOT_FOLDER / ".purge.lock")
+    try:
+        lock.acquire(timeout=0)
+    except LockTimeout:
+        print("Purge is already running")
+        return
+    started = time.monotonic()
+    try:
+        now = datetime.datetime.today()
+        with FileLock(ROOT_FOLDER / ".expiry.lock"):
+            index = read_expiry_index()
+        print(f"{len(index)} folders in {ROOT_FOLDER}")
+        purged = set()
+        for created, folder in index:
+            dt = datetime.datetime.fromtimestamp(created)
+            if (age := (now - dt).days) <= RETENTION_DAYS:
+                # Index is ordered, next ones are younger.
+                break
+            purged.add(folder)
+            if not folder_path(folder).exists():
+                # Deleted via the API.
+                continue
+            files = read_manifest(folder)["files"]
+            size = sum(info["size"] for info in files.values())
+            print(f"Purging old folder {folder} (age={age}, size={size})")
+            if remove_folder(folder):
+                purged_folders.inc()
+
+        if purged:
+            with FileLock(ROOT_FOLDER / ".expiry.lock"):
+                # Folders may have been created in the meantime.
+                index = read_expiry_index()
+                write_expiry_index([(c, f) for c, f in index if f not in purged])
+    finally:
+        lock.release()
+        purge_duration.observe(time.monotonic() - started)
+
+
+async def purge_periodically():
+    while True:
+        try:
+            await bulk_io.run(purge_old_folders, reject=False)
+        except Exception as exc:
+            print(f"Could not purge old folders: {exc}")
+        await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+
+
+def open_folder_archive(folder_id):
+    """
+    Open the last published snapshot of the folder archive, if any.
+
+    Snapshots are replaced atomically, so the opened file is always a complete
+    archive and remains readable even if a newer snapshot is published.
+    """
+    try:
+        return open(folder_path(folder_id, ".zip"), "rb")
+    except FileNotFoundError:
+        return None
+
+
+def archive_missing_files(folder_id, snapshot):
+    filenames = list(load_manifest(folder_id)["files"])
+    if snapshot is None:
+        return filenames
+    with zipfile.ZipFile(snapshot) as archive:
+        existing = set(archive.namelist())
+    return [filename for filename in filenames if filename not in existing]
+
+
+def archive_compress_type(path: Path) -> int:
+    """
+    Return ``ZIP_DEFLATED`` if the file is worth compressing in the archive.
+    """
+    if path.suffix.lower() in ARCHIVE_STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    with open(path, "rb") as f:
+        sample = f.read(ARCHIVE_COMPRESS_SAMPLE_SIZE)
+    if not sample:
+        return zipfile.ZIP_STORED
+    compressed = zlib.compress(sample, 1)
+    if len(compressed) > len(sample) * ARCHIVE_COMPRESS_MIN_RATIO:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def deflate_file(path: Path, filename: str, tmp_dir: Path):
+    """
+    Compress the file into a temporary file, and return the archive entry along
+    with the compressed data (or ``None`` if it does not shrink).
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, filename)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    compressor = zlib.compressobj(ARCHIVE_COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    crc = 0
+    data = tempfile.TemporaryFile(dir=tmp_dir)
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(ARCHIVE_CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                data.write(compressor.compress(chunk))
+        data.write(compressor.flush())
+        zinfo.CRC = crc
+        zinfo.compress_size = data.tell()
+        if zinfo.compress_size >= zinfo.file_size:
+            data.close()
+            return zinfo, None
+        data.seek(0)
+        return zinfo, data
+    except BaseException:
+        data.close()
+        raise
+
+
+def write_deflated(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo, data):
+    """
+    Append an entry whose data was already compressed by ``deflate_file()``.
+
+    Only for ``ARCHIVE_PRE_DEFLATED_VERSIONS`` of Python.
+    """
+    # zipfile only compresses entries itself: write the local header and the
+    # data, and register the entry for the central directory like it does.
+    archive.fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.start_dir
+    archive.fp.write(zinfo.FileHeader())
+    shutil.copyfileobj(data, archive.fp, ARCHIVE_CHUNK_SIZE)
+    archive.start_dir = archive.fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    archive._didModify = True
+
+
+archive_compressor = ThreadPoolExecutor(
+    max_workers=ARCHIVE_COMPRESS_WORKERS, thread_name_prefix="besace-deflate"
+)
+
+
+def write_archive_entries(archive: zipfile.ZipFile, folder_dir: Path, filenames):
+    """
+    Append the files to the archive in order, while the compressible ones are
+    deflated in parallel (zlib releases the GIL).
+    """
+    tmp_dir = Path(archive.filename).parent
+    pre_deflated = sys.version_info[:2] in ARCHIVE_PRE_DEFLATED_VERSIONS
+    # Files (with their deflating job, if any) waiting to be written.
+    window = collections.deque()
+
+    def write_next():
+        filename, compress_type, deflating = window.popleft()
+        if deflating is not None:
+            zinfo, data = deflating.result()
+            if data is not None:
+                with data:
+                    write_deflated(archive, zinfo, data)
+                return
+            compress_type = zipfile.ZIP_STORED
+        archive.write(
+            folder_dir / filename,
+            filename,
+            compress_type=compress_type,
+            compresslevel=ARCHIVE_COMPRESS_LEVEL,
+        )
+
+    try:
+        for filename in filenames:
+            compress_type = archive_compress_type(folder_dir / filename)
+            deflating = None
+            if compress_type == zipfile.ZIP_DEFLATED and pre_deflated:
+                deflating = archive_compressor.submit(
+                    deflate_file, folder_dir / filename, filename, tmp_dir
+                )
+            window.append((filename, compress_type, deflating))
+            if len(window) > ARCHIVE_COMPRESS_WINDOW:
+                write_next()
+        while window:
+            write_next()
+    finally:
+        # Interrupted: discard the compressed data of the remaining files.
+        for _, _, future in window:
+            if future is None or future.cancel() or future.exception() is not None:
+                continue
+            _, data = future.result()
+            if data is not None:
+                data.close()
+
+
+def snapshot_version(folder_id, snapshot):
+    """
+    Return the version of the folder that the snapshot is complete up to.
+    """
+    manifest = load_manifest(folder_id)
+    with zipfile.ZipFile(snapshot) as archive:
+        existing = set(archive.namelist())
+    missing = [
+        info["version"]
+        for filename, info in manifest["files"].items()
+        if filename not in existing
     ]
-    print(f"{len(folders)} folders in {ROOT_FOLDER}")
-    for folder, timestamp in folders:
-        dt = datetime.datetime.fromtimestamp(timestamp)
-        if (age := (now - dt).days) > RETENTION_DAYS:
-            print(f"Purging old folder {folder} (age={age})")
-            delete_folder(folder_id=folder, _secret="")
+    return min(missing) - 1 if missing else manifest["version"]
+
+
+def archive_waste(path: Path):
+    """
+    Return the part of the archive size that no entry uses (ie. the central
+    directories of its previous versions, see ``update_folder_archive()``).
+    """
+    size = path.stat().st_size
+    with zipfile.ZipFile(path) as archive:
+        used = sum(
+            # Local header, name, extra field and data.
+            30 + len(info.orig_filename.encode()) + len(info.extra) + info.compress_size
+            for info in archive.infolist()
+        )
+        used += size - archive.start_dir
+    return (size - used) / size if size else 0
+
+
+def update_folder_archive(folder_id, timeout=LOCK_TIMEOUT_SECONDS):
+    """
+    Publish a new snapshot of the folder archive with the missing files.
+
+    Two archives are kept: the published snapshot, and the previous one
+    (``.zip.next``), which is brought up to date and then atomically published
+    in turn. Its new entries and central directory are written after its end,
+    so that downloads which may still read it are never altered, and only the
+    new files are written (the previous central directory remains, unused).
+    Raises ``LockTimeout`` if another update takes too long.
+    """
+    # Acquire a lock on disk (works across containers if they share a volume)
+    lock = folder_lock(folder_id, ".zip.lock")
+    try:
+        with archive_lock_wait.time():
+            acquired = lock.acquire(timeout=timeout)
+    except LockTimeout:
+        archive_lock_timeouts.inc()
+        raise
+    with acquired:
+        # Resolved once locked (the folder cannot be migrated meanwhile).
+        folder_dir = folder_path(folder_id)
+        folder_archive = folder_path(folder_id, ".zip")
+        next_archive = folder_path(folder_id, ".zip.next")
+        previous_archive = folder_path(folder_id, ".zip.previous")
+        in_place = sys.version_info[:2] in ARCHIVE_PRE_DEFLATED_VERSIONS
+        snapshot = open_folder_archive(folder_id)
+        try:
+            missing = archive_missing_files(folder_id, snapshot)
+            if not missing and snapshot is not None:
+                return
+            print(f"Updating archive '{folder_archive}'")
+            previous_archive.unlink(missing_ok=True)
+            reuse = in_place and next_archive.exists()
+            compact = reuse and archive_waste(next_archive) > ARCHIVE_MAX_WASTE_RATIO
+            if compact:
+                # Rebuilt from scratch, since its waste would be copied too.
+                print(f"Compacting archive '{folder_archive}'")
+                reuse = False
+            if not reuse:
+                # Unlinked, not truncated: it may still be read.
+                next_archive.unlink(missing_ok=True)
+            if not reuse and not compact and snapshot is not None:
+                # Full copy of the snapshot (only once per folder in place).
+                shutil.copyfile(snapshot.name, next_archive)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        with zipfile.ZipFile(next_archive, "a") as archive:
+            existing = set(archive.namelist())
+            if reuse:
+                # Write after the end, instead of over the central directory.
+                archive.start_dir = archive.fp.seek(0, os.SEEK_END)
+            write_archive_entries(
+                archive,
+                folder_dir,
+                [f for f in load_manifest(folder_id)["files"] if f not in existing],
+            )
+        if in_place and folder_archive.exists():
+            # Keep the published snapshot, to update it next time.
+            os.link(folder_archive, previous_archive)
+            os.replace(next_archive, folder_archive)
+            os.replace(previous_archive, next_archive)
+        else:
+            os.replace(next_archive, folder_archive)
+
+
+async def iter_file(file, start, length, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Read ``length`` bytes of the opened file from ``start``, chunk by chunk in
+    the bulk pool, and close it.
+    """
+    try:
+        while length > 0:
+            # Never rejected: the response was already started.
+            chunk = await bulk_io.run(
+                os.pread, file.fileno(), min(chunk_size, length), start, reject=False
+            )
+            if not chunk:
+                break
+            start += len(chunk)
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def parse_range(http_range, size):
+    """
+    Return the ``(start, end)`` of a single bytes range, or ``None`` if the
+    header is not supported (eg. multiple ranges) and should be ignored.
+    """
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", http_range.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def file_response(request: Request, file, headers, media_type):
+    """
+    Send the opened file, with support of ``Range`` and ``If-Range`` requests.
+    """
+    stat = os.fstat(file.fileno())
+    # A new snapshot (or thumbnail) is a new inode.
+    etag = f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {**headers, "ETag": etag, "Accept-Ranges": "bytes"}
+    http_range = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if http_range and (if_range is None or if_range == etag):
+        try:
+            byte_range = parse_range(http_range, stat.st_size)
+        except HTTPException:
+            file.close()
+            raise
+    if byte_range is None:
+        headers["Content-Length"] = str(stat.st_size)
+        # Bounded: a snapshot may grow once it is not published anymore.
+        return StreamingResponse(
+            iter_file(file, 0, stat.st_size),
+            media_type=media_type,
+            headers=headers,
+        )
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    return StreamingResponse(
+        iter_file(file, start, end - start + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+def sendfile_response(path: Path, headers):
+    """
+    Let the reverse proxy send the file (zero-copy).
+    """
+    relative = path.relative_to(ROOT_FOLDER).as_posix()
+    if SENDFILE_HEADER.lower() == "x-accel-redirect":
+        location = SENDFILE_PREFIX + urllib.parse.quote(relative)
+    else:
+        location = os.path.join(SENDFILE_PREFIX, relative)
+    return Response(headers={**headers, SENDFILE_HEADER: location})
+
+
+class ArchiveBuilder:
+    """
+    Update folders archives in the bulk pool.
+
+    Builds are debounced per folder on the event loop (consecutive uploads
+    postpone the build) and at most ``concurrency`` archives are updated at the
+    same time, leaving the other workers of the pool to downloads.
+    """
+
+    def __init__(self, delay: float, concurrency: int):
+        self.delay = delay
+        self.concurrency = concurrency
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.slots: asyncio.Semaphore | None = None
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.running: set[asyncio.Task] = set()
+
+    def start(self):
+        """
+        Bind to the running event loop (on startup).
+        """
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.concurrency)
+
+    def schedule(self, folder_id: str):
+        """
+        Schedule a build of the folder archive (thread-safe, since uploads are
+        stored in the bulk pool).
+        """
+        if self.loop is None:
+            print(f"Could not schedule archive of '{folder_id}': not started")
+            return
+        self.loop.call_soon_threadsafe(self.postpone, folder_id)
+
+    def postpone(self, folder_id: str):
+        if (task := self.tasks.pop(folder_id, None)) is not None:
+            task.cancel()
+        self.tasks[folder_id] = asyncio.create_task(self.build(folder_id))
+
+    async def build(self, folder_id: str):
+        await asyncio.sleep(self.delay)
+        # Not postponed anymore once started.
+        task = self.tasks.pop(folder_id)
+        self.running.add(task)
+        try:
+            async with self.slots:
+                await bulk_io.run(self.update, folder_id, reject=False)
+        except Exception as exc:
+            print(f"Could not build archive of '{folder_id}': {exc}")
+        finally:
+            self.running.discard(task)
+
+    @staticmethod
+    def update(folder_id: str):
+        if not folder_path(folder_id).exists():
+            # Deleted in the meantime.
+            return
+        update_folder_archive(folder_id)
+
+    def cancel(self):
+        for task in [*self.tasks.values(), *self.running]:
+            task.cancel()
+        self.tasks.clear()
+
+
+archive_builder = ArchiveBuilder(
+    delay=ARCHIVE_BUILD_DELAY_SECONDS, concurrency=ARCHIVE_BUILD_CONCURRENCY
+)
+
+
+class IOPool:
+    """
+    Run blocking calls in a dedicated pool of threads.
+
+    If ``backlog`` is set, at most ``workers + backlog`` calls can be running or
+    waiting at the same time, and further calls are rejected with a 503 response.
+    """
+
+    def __init__(self, name: str, workers: int, backlog: int | None = None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"besace-{name}"
+        )
+        self.slots = (
+            None if backlog is None else threading.BoundedSemaphore(workers + backlog)
+        )
+
+    async def run(self, func, *args, reject: bool = True, **kwargs):
+        """
+        Run ``func`` in the pool. Internal jobs that must not be dropped
+        (eg. tusd hooks, purge) are queued with ``reject=False``.
+        """
+        if self.slots is not None and reject:
+            if not self.slots.acquire(blocking=False):
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server is busy, please retry later",
+                    headers={"Retry-After": str(BULK_IO_RETRY_AFTER_SECONDS)},
+                )
+            future = self.executor.submit(func, *args, **kwargs)
+            # Released when the job is done, even if the client went away.
+            future.add_done_callback(lambda _: self.slots.release())
+        else:
+            future = self.executor.submit(func, *args, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+fast_io = IOPool("fast", workers=FAST_IO_WORKERS)
+bulk_io = IOPool("bulk", workers=BULK_IO_WORKERS, backlog=BULK_IO_BACKLOG)
+
+
+folders_hashes: dict[str, tuple[int, set[str]]] = {}
+folders_hashes_lock = threading.Lock()
+
+
+def known_hashes(folder_id):
+    """
+    Return the set of MD5 hashes of the files uploaded in the folder.
+
+    The set is loaded lazily from the ``.md5`` file, and only the lines appended
+    since the last call (eg. by other workers) are read. Hashes are appended when
+    an upload is received, and again along the filename (``md5  filename``) when
+    it is moved into the folder.
+    """
+    md5file = folder_path(folder_id, ".md5")
+    offset, hashes = folders_hashes.get(folder_id, (0, set()))
+    try:
+        size = md5file.stat().st_size
+    except FileNotFoundError:
+        size = 0
+    if size < offset:
+        # File was recreated.
+        offset, hashes = 0, set()
+    if size > offset:
+        with open(md5file, "rb") as f:
+            f.seek(offset)
+            content = f.read(size - offset)
+        # Ignore a line that is being written.
+        content = content[: content.rfind(b"\n") + 1]
+        hashes.update(
+            line.split("  ", 1)[0].strip() for line in content.decode().splitlines()
+        )
+        hashes.discard("")
+        offset += len(content)
+    folders_hashes[folder_id] = (offset, hashes)
+    return hashes
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(ARCHIVE_CHUNK_SIZE):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def stage_upload(source: Path):
+    """
+    Bring the uploaded file on the same volume as the folders (copy if needed).
+    """
+    staging = ROOT_FOLDER / f".{source.name}.upload"
+    shutil.move(source, staging)
+    return staging
+
+
+def move_upload(staging: Path, folder_id, filename, md5hash):
+    """
+    Move the staged file into the folder, and return its final filename.
+
+    If a file with the same name exists, the new one is suffixed (eg. ``a (2).jpg``).
+    Must be called with the manifest lock held, so that no other upload takes
+    the same name meanwhile.
+    """
+    folder_dir = folder_path(folder_id)
+    stem, extension = os.path.splitext(filename)
+    candidate = filename
+    suffix = 2
+    while (folder_dir / candidate).exists():
+        candidate = f"{stem} ({suffix}){extension}"
+        suffix += 1
+    # Recorded before the move, so that the thumbnailer does not hash it again.
+    with open(folder_path(folder_id, ".md5"), "a") as f:
+        f.write(f"{md5hash}  {candidate}\n")
+    # Renamed, so that the thumbnailer sees a complete file moved in.
+    os.rename(staging, folder_dir / candidate)
+    return candidate
+
+
+def thumbnail_path(folder_id, file_name, size) -> Path:
+    thumbnails_dir = Path(THUMBNAILS_FOLDER) / folder_id
+    if size != THUMBNAIL_DEFAULT_SIZE:
+        thumbnails_dir = thumbnails_dir / f"{size}px"
+    return thumbnails_dir / f"{file_name}{THUMBNAIL_EXTENSION}"
+
+
+def make_thumbnail(source: Path, output: Path, size: int):
+    """
+    Create the thumbnail of the file with the thumbnailer, and return ``False``
+    if it failed.
+
+    The thumbnail is written aside and renamed, so that it is never served
+    partially written.
+    """
+    if output.exists():
+        # Created by the thumbnailer or another worker meanwhile.
+        return True
+    output.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=output.parent, prefix=".", suffix=THUMBNAIL_EXTENSION
+    )
+    os.close(fd)
+    try:
+        # Errors are printed and ignored by the thumbnailer.
+        thumbnailer.create_thumbnail(
+            str(source), tmp_path, (size, size), THUMBNAIL_FRAME_TIME
+        )
+        if os.path.getsize(tmp_path) == 0:
+            return False
+        os.replace(tmp_path, output)
+        return True
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
 
 
 @functools.cache
@@ -136,17 +1301,331 @@ def load_dictionnary():
     return selection
 
 
+def dos_datetime(timestamp: float) -> tuple[int, int]:
+    dt = datetime.datetime.fromtimestamp(max(timestamp, 315532800))  # 1980-01-01
+    dostime = dt.hour << 11 | dt.minute << 5 | dt.second // 2
+    dosdate = (dt.year - 1980) << 9 | dt.month << 5 | dt.day
+    return dostime, dosdate
+
+
+def zip_entry_layout(entries: list[tuple[str, int, float]]):
+    """
+    Yield ``(filename, size, mtime, offset)`` for each entry of a streamed archive,
+    and finally the offset of the central directory and its size.
+
+    Entries are STORED with a data descriptor, so that the total size of the
+    archive is known before reading any file.
+    """
+    offset = 0
+    central_size = 0
+    for filename, size, mtime in entries:
+        zip64 = size >= ZIP64_LIMIT
+        name_length = len(filename.encode())
+        central_fields = (2 if zip64 else 0) + (1 if offset >= ZIP64_LIMIT else 0)
+        yield filename, size, mtime, offset
+        offset += 30 + name_length + (20 if zip64 else 0)
+        offset += size
+        offset += 24 if zip64 else 16
+        central_size += (
+            46 + name_length + (4 + 8 * central_fields if central_fields else 0)
+        )
+    yield offset, central_size
+
+
+def zip_stream_size(entries: list[tuple[str, int, float]]) -> int:
+    *_, (central_offset, central_size) = zip_entry_layout(entries)
+    zip64 = (
+        len(entries) >= ZIP_FILECOUNT_LIMIT
+        or central_offset >= ZIP64_LIMIT
+        or central_size >= ZIP64_LIMIT
+    )
+    return central_offset + central_size + 22 + (56 + 20 if zip64 else 0)
+
+
+def read_chunk(file, size, crc):
+    chunk = file.read(size)
+    return chunk, zlib.crc32(chunk, crc)
+
+
+async def zip_stream(folder_dir: Path, entries: list[tuple[str, int, float]]):
+    """
+    Generate a ZIP archive of the specified files chunk by chunk, without
+    seeking nor writing anything on disk. Files are read in the bulk pool.
+    """
+    flags = 0x08 | 0x800  # Data descriptor, UTF-8 filenames.
+    central = []
+    *layout, (central_offset, central_size) = zip_entry_layout(entries)
+    for filename, size, mtime, offset in layout:
+        name = filename.encode()
+        zip64 = size >= ZIP64_LIMIT
+        version = 45 if zip64 or offset >= ZIP64_LIMIT else 20
+        dostime, dosdate = dos_datetime(mtime)
+
+        local_extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0) if zip64 else b""
+        local_size = ZIP64_LIMIT if zip64 else 0
+        yield struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            version,
+            flags,
+            zipfile.ZIP_STORED,
+            dostime,
+            dosdate,
+            0,
+            local_size,
+            local_size,
+            len(name),
+            len(local_extra),
+        )
+        yield name + local_extra
+
+        crc = 0
+        remaining = size
+        # Never rejected: the response was already started.
+        f = await bulk_io.run(open, folder_dir / filename, "rb", reject=False)
+        try:
+            while remaining:
+                chunk, crc = await bulk_io.run(
+                    read_chunk, f, min(ARCHIVE_CHUNK_SIZE, remaining), crc, reject=False
+                )
+                if not chunk:
+                    raise RuntimeError(f"File '{filename}' was truncated while zipped")
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+        descriptor_format = "<IIQQ" if zip64 else "<IIII"
+        yield struct.pack(descriptor_format, 0x08074B50, crc, size, size)
+
+        # Only values that overflow are moved to the Zip64 extra field.
+        central_values = [size, size] if zip64 else []
+        if offset >= ZIP64_LIMIT:
+            central_values.append(offset)
+        central_extra = (
+            struct.pack(
+                f"<HH{len(central_values)}Q",
+                0x0001,
+                8 * len(central_values),
+                *central_values,
+            )
+            if central_values
+            else b""
+        )
+        central.append(
+            struct.pack(
+                "<IHHHHHHIIIHHHHHII",
+                0x02014B50,
+                3 << 8 | version,  # Made by Unix
+                version,
+                flags,
+                zipfile.ZIP_STORED,
+                dostime,
+                dosdate,
+                crc,
+                min(size, ZIP64_LIMIT),
+                min(size, ZIP64_LIMIT),
+                len(name),
+                len(central_extra),
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                min(offset, ZIP64_LIMIT),
+            )
+            + name
+            + central_extra
+        )
+
+    yield b"".join(central)
+
+    count = len(entries)
+    if (
+        count >= ZIP_FILECOUNT_LIMIT
+        or central_offset >= ZIP64_LIMIT
+        or central_size >= ZIP64_LIMIT
+    ):
+        zip64_end_offset = central_offset + central_size
+        yield struct.pack(
+            "<IQHHIIQQQQ",
+            0x06064B50,
+            44,
+            3 << 8 | 45,
+            45,
+            0,
+            0,
+            count,
+            count,
+            central_size,
+            central_offset,
+        )
+        yield struct.pack("<IIQI", 0x07064B50, 0, zip64_end_offset, 1)
+    yield struct.pack(
+        "<IHHHHIIH",
+        0x06054B50,
+        0,
+        0,
+        min(count, ZIP_FILECOUNT_LIMIT),
+        min(count, ZIP_FILECOUNT_LIMIT),
+        min(central_size, ZIP64_LIMIT),
+        min(central_offset, ZIP64_LIMIT),
+        0,
+    )
+
+
+class MetricsMiddleware:
+    """
+    Count the requests and measure their duration per route, until the
+    response is entirely sent (ie. including streamed bodies).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+        sent = 0
+
+        async def send_and_measure(message):
+            nonlocal status_code, sent
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_measure)
+        finally:
+            # Set by the router once the route is resolved.
+            endpoint = scope.get("endpoint")
+            route = endpoint.__name__ if endpoint is not None else "unmatched"
+            requests_total.labels(route, scope["method"], str(status_code)).inc()
+            request_duration.labels(route).observe(time.perf_counter() - started)
+            response_bytes.labels(route).inc(sent)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     startup_check()
+    await bulk_io.run(measure_storage, reject=False)
+    archive_builder.start()
+    purge_task = asyncio.create_task(purge_periodically())
     yield
+    purge_task.cancel()
+    archive_builder.cancel()
+    fast_io.shutdown()
+    bulk_io.shutdown()
+    archive_compressor.shutdown(wait=False, cancel_futures=True)
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+
+class HookUpload(BaseModel):
+    ID: str
+    MetaData: dict[str, str] = {}
+
+
+class HookEvent(BaseModel):
+    Upload: HookUpload
+
+
+class HookRequest(BaseModel):
+    Type: str
+    Event: HookEvent
+
+
+def reject_upload(status_code, detail):
+    print(f"Reject upload: {detail}")
+    return {
+        "RejectUpload": True,
+        "HTTPResponse": {
+            "StatusCode": status_code,
+            "Body": json.dumps({"detail": detail}),
+            "Header": {"Content-Type": "application/json"},
+        },
+    }
+
+
+def check_upload(upload: HookUpload):
+    metadata = upload.MetaData
+    try:
+        folder_id = check_folder_id(metadata.get("folderId", ""))
+        check_filename(metadata.get("filename", ""))
+    except AssertionError as exc:
+        return reject_upload(400, str(exc))
+    if not folder_path(folder_id).is_dir():
+        return reject_upload(404, f"Unknown folder '{folder_id}'")
+    # Clients can send the hash of the file, to avoid uploading duplicates.
+    # (the hash is computed again when finished, the index cannot be poisoned)
+    md5hash = metadata.get("md5", "").lower()
+    if md5hash:
+        with folders_hashes_lock:
+            duplicate = md5hash in known_hashes(folder_id)
+        if duplicate:
+            return reject_upload(
+                409, f"File '{metadata['filename']}' is already in the folder"
+            )
+    return {}
+
+
+def store_upload(upload: HookUpload):
+    source = INCOMING_FOLDER / upload.ID
+    info = INCOMING_FOLDER / f"{upload.ID}.info"
+    try:
+        assert Path(upload.ID).name == upload.ID, f"{upload.ID} has bad format"
+        folder_id = check_folder_id(upload.MetaData.get("folderId", ""))
+        filename = check_filename(upload.MetaData.get("filename", ""))
+        assert folder_path(folder_id).is_dir(), f"Unknown folder '{folder_id}'"
+    except AssertionError as exc:
+        print(f"Ignore upload {upload.ID}: {exc}")
+        return {}
+
+    md5hash = file_md5(source)
+    if (announced := upload.MetaData.get("md5")) and announced.lower() != md5hash:
+        print(f"Upload {upload.ID} announced md5 {announced!r} but is {md5hash}")
+    # The folder files cannot be moved (migration) while the lock is held.
+    with folder_lock(folder_id, ".manifest.lock"), folders_hashes_lock:
+        if not folder_path(folder_id).is_dir():
+            print(f"Ignore upload {upload.ID}: folder '{folder_id}' was deleted")
+            source.unlink(missing_ok=True)
+            info.unlink(missing_ok=True)
+            return {}
+        if md5hash in known_hashes(folder_id):
+            print(f"Ignoring duplicate file '{filename}'")
+            source.unlink(missing_ok=True)
+            info.unlink(missing_ok=True)
+            return {}
+        with open(folder_path(folder_id, ".md5"), "a") as f:
+            f.write(f"{md5hash}\n")
+        known_hashes(folder_id)
+
+    size = source.stat().st_size
+    staging = stage_upload(source)
+    info.unlink(missing_ok=True)
+    with folder_lock(folder_id, ".manifest.lock"):
+        folder_dir = folder_path(folder_id)
+        if not folder_dir.is_dir():
+            print(f"Ignore upload {upload.ID}: folder '{folder_id}' was deleted")
+            staging.unlink(missing_ok=True)
+            return {}
+        dir_mtime_before = folder_dir.stat().st_mtime_ns
+        filename = move_upload(staging, folder_id, filename, md5hash)
+        add_to_manifest(folder_id, filename, dir_mtime_before)
+    stored_bytes.inc(size)
+    print(f"Moved uploaded file {upload.ID} to {folder_dir / filename}")
+    if ARCHIVE_MODE == "cache":
+        archive_builder.schedule(folder_id)
+    return {}
 
 
 @app.get("/")
-def read_root(request: Request):
+async def read_root(request: Request):
     root_url = request.url_for("read_root")
     return {
         "Hello": "World",
@@ -155,119 +1634,359 @@ def read_root(request: Request):
     }
 
 
-@app.post("/folder")
-def create_folder(
-    request: Request,
-    user_agent: Annotated[str | None, Header()],
-    dictionnary: list[str] = Depends(load_dictionnary),
-    secret: str = Security(check_api_secret),
-):
-    purge_old_folders()
-
+def make_folder(dictionnary, metadata):
+    """
+    Create a folder with a random name, and return its ID.
+    """
     while "new folder does not exist":
         words = random.sample(dictionnary, FOLDER_WORDS_COUNT)
         folder_id = "-".join(words)
-        folder_dir = ROOT_FOLDER / folder_id
+        folder_dir = folder_path(folder_id)
         if not folder_dir.exists():
             break
 
-    folder_dir.mkdir(exist_ok=True)
+    folder_dir.mkdir(parents=True, exist_ok=True)
+    folders_count.inc()
+    with open(folder_path(folder_id, ".meta"), "w") as f:
+        json.dump(metadata, f)
+    add_to_expiry_index(folder_id, metadata["created"])
+    print(f"Created new folder {folder_dir}")
+    return folder_id
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/folder")
+async def create_folder(
+    request: Request,
+    user_agent: Annotated[str | None, Header()],
+    dictionnary: list[str] = Depends(load_dictionnary),
+    secret: str = Security(check_api_secret),
+):
     metadata = {
         "created": int(time.time()),
         "host": request.client.host,
         "user-agent": user_agent,
         "secret": f"{secret[:LOG_SECRET_REVEAL_LENGTH]}...",
     }
-    with open(ROOT_FOLDER / f"{folder_id}.meta", "w") as f:
-        json.dump(metadata, f)
+    folder_id = await fast_io.run(make_folder, dictionnary, metadata)
 
-    print(f"Created new folder {folder_dir}")
     redirect_url = request.url_for("get_folder", **{"folder_id": str(folder_id)})
     return RedirectResponse(redirect_url, status_code=303)
 
 
+def folder_etag(manifest, ndjson=False):
+    # Representations differ by media type (``Vary: Accept``).
+    suffix = "-ndjson" if ndjson else ""
+    return f'"v{manifest["version"]}-{RETENTION_DAYS}{suffix}"'
+
+
+def listing_key(info):
+    # Most recent first.
+    return (-info["modified"], info["filename"])
+
+
+def encode_cursor(key):
+    modified, filename = key
+    token = orjson.dumps([-modified, filename])
+    return base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        token = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        modified, filename = orjson.loads(token)
+        return (-float(modified), str(filename))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail=f"Invalid cursor '{cursor}'")
+
+
+def list_files(files, limit=None, after=None):
+    """
+    Return the files ordered by listing key, with the key of the last one if
+    there are more (ie. next page cursor).
+    """
+    if after is not None:
+        files = (info for info in files if listing_key(info) > after)
+    if limit is None:
+        return sorted(files, key=listing_key), None
+    # Avoids sorting the whole folder for one page.
+    page = heapq.nsmallest(limit + 1, files, key=listing_key)
+    if len(page) <= limit:
+        return page, None
+    return page[:limit], listing_key(page[limit - 1])
+
+
+async def iter_ndjson(details, files):
+    # Iterated on the event loop: no I/O, and batches are small.
+    yield orjson.dumps(details) + b"\n"
+    for i in range(0, len(files), LIST_STREAM_BATCH_SIZE):
+        batch = files[i : i + LIST_STREAM_BATCH_SIZE]
+        yield b"".join(orjson.dumps(info) + b"\n" for info in batch)
+
+
 @app.get("/folder/{folder_id}")
-def get_folder(folder_id: FolderId):
-    folder_dir = ROOT_FOLDER / folder_id
-    if not folder_dir.exists():
+async def get_folder(
+    folder_id: FolderId,
+    limit: Annotated[int | None, Query(ge=1, le=LIST_LIMIT_MAX)] = None,
+    cursor: str | None = None,
+    accept: Annotated[str | None, Header()] = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    """
+    List the files of the folder, most recent first.
+
+    Pages of ``limit`` files can be obtained by passing the ``next_cursor``
+    of the previous page. With ``Accept: application/x-ndjson``, the folder
+    details are sent on the first line, and then one file per line.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    try:
+        manifest = await fast_io.run(load_manifest, folder_id)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"Unknown folder '{folder_id}'")
+    ndjson = bool(accept and "application/x-ndjson" in accept)
+    etag = folder_etag(manifest, ndjson)
+    # Browsers should always revalidate their copy.
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if if_none_match is not None:
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers=headers)
 
-    files = [
-        {
-            "filename": path.name,
-            "size": path.stat().st_size,
-            "modified": path.stat().st_mtime,
-        }
-        for path in folder_dir.iterdir()
-        if path.is_file()
-    ]
-    return {
-        **get_folder_metadata(folder_id),
+    metadata = await fast_io.run(get_folder_metadata, folder_id)
+    files, next_key = list_files(manifest["files"].values(), limit, after)
+    details = {
+        **metadata,
         "folder": folder_id,
-        "files": sorted(files, key=lambda v: v["modified"], reverse=True),
+        "version": manifest["version"],
+        "next_cursor": encode_cursor(next_key) if next_key else None,
         "settings": {
             "retention_days": RETENTION_DAYS,
         },
     }
+    if ndjson:
+        return StreamingResponse(
+            iter_ndjson(details, files),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+    return Response(
+        orjson.dumps({**details, "files": files}),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+@app.get("/folder/{folder_id}/changes")
+async def get_folder_changes(
+    folder_id: FolderId,
+    since: Annotated[int, Query(ge=0)],
+    timeout: Annotated[float, Query(ge=0)] = CHANGES_TIMEOUT_SECONDS,
+):
+    """
+    Long-poll the files added or removed since the specified version.
+    """
+    deadline = time.monotonic() + min(timeout, CHANGES_TIMEOUT_SECONDS)
+    while True:
+        try:
+            manifest = await fast_io.run(load_manifest, folder_id)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Unknown folder '{folder_id}'")
+        if manifest["version"] != since or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(CHANGES_POLL_SECONDS)
+
+    # If the client is ahead (eg. folder was recreated), send everything.
+    since = since if since <= manifest["version"] else 0
+    return {
+        "version": manifest["version"],
+        "added": sorted(
+            (f for f in manifest["files"].values() if f["version"] > since),
+            key=lambda v: v["modified"],
+            reverse=True,
+        ),
+        "removed": [
+            filename
+            for filename, version in manifest["removed"].items()
+            if version > since
+        ],
+    }
 
 
 @app.get("/folder/{folder_id}/download")
-def get_folder_archive(folder_id: FolderId):
-    folder_dir = ROOT_FOLDER / folder_id
-    if not folder_dir.exists():
+async def get_folder_archive(
+    folder_id: FolderId,
+    request: Request,
+    since: Annotated[int | None, Query(ge=0)] = None,
+):
+    """
+    Download the folder archive, or only the files added since the version
+    returned in the ``X-Folder-Version`` header of a previous download.
+    """
+    folder_dir = await fast_io.run(folder_path, folder_id)
+    if not await fast_io.run(folder_dir.exists):
         raise HTTPException(status_code=404, detail=f"Unknown folder '{folder_id}'")
 
-    filenames = [path.name for path in folder_dir.iterdir() if path.is_file()]
-    folder_archive = ROOT_FOLDER / f"{folder_id}.zip"
-    lockfile = ROOT_FOLDER / f"{folder_id}.zip.lock"
+    headers = {"Content-Disposition": f'attachment; filename="{folder_id}.zip"'}
 
-    # Acquire a lock on disk (works across containers if they share a volume)
-    lock = FileLock(lockfile)
-    try:
-        with lock.acquire(timeout=LOCK_TIMEOUT_SECONDS):
-            print(f"Updating archive '{folder_archive}'")
-            with zipfile.ZipFile(folder_archive, "a") as archive:
-                existing = archive.namelist()
-                for filename in filenames:
-                    if filename not in existing:
-                        archive.write(folder_dir / filename, filename)
-    except LockTimeout:
-        raise HTTPException(
-            status_code=503, detail="Could not acquire lock to update archive"
+    if ARCHIVE_MODE == "stream" or since is not None:
+        manifest = await fast_io.run(load_manifest, folder_id)
+        # If the client is ahead (eg. folder was recreated), send everything.
+        since = since if since is not None and since <= manifest["version"] else 0
+        entries = [
+            (info["filename"], info["size"], info["modified"])
+            for _, info in sorted(manifest["files"].items())
+            if info["version"] > since
+        ]
+        if since:
+            headers["Content-Disposition"] = (
+                f'attachment; filename="{folder_id}-{since}.zip"'
+            )
+        headers["X-Folder-Version"] = str(manifest["version"])
+        headers["Content-Length"] = str(zip_stream_size(entries))
+        return StreamingResponse(
+            zip_stream(folder_dir, entries),
+            media_type="application/zip",
+            headers=headers,
         )
 
-    headers = {"Content-Disposition": f'attachment; filename="{folder_id}.zip"'}
-    return FileResponse(folder_archive, headers=headers)
+    snapshot = await fast_io.run(open_folder_archive, folder_id)
+    if snapshot is None or await fast_io.run(
+        archive_missing_files, folder_id, snapshot
+    ):
+        # Only wait for the lock if there is no previous snapshot to serve.
+        timeout = LOCK_TIMEOUT_SECONDS if snapshot is None else 0
+        try:
+            await bulk_io.run(update_folder_archive, folder_id, timeout=timeout)
+        except LockTimeout:
+            if snapshot is None:
+                raise HTTPException(
+                    status_code=503, detail="Could not acquire lock to update archive"
+                )
+            print(f"Archive of '{folder_id}' is being updated, serve previous one")
+        except HTTPException:
+            # Too many bulk jobs queued.
+            if snapshot is None:
+                raise
+            print(f"Server is busy, serve previous archive of '{folder_id}'")
+        else:
+            if snapshot is not None:
+                snapshot.close()
+            snapshot = await fast_io.run(open_folder_archive, folder_id)
+
+    version = await fast_io.run(snapshot_version, folder_id, snapshot)
+    headers["X-Folder-Version"] = str(version)
+    if SENDFILE_HEADER:
+        snapshot.close()
+        return sendfile_response(Path(snapshot.name), headers)
+    return file_response(request, snapshot, headers, "application/zip")
 
 
 @app.delete("/folder/{folder_id}")
-def delete_folder(folder_id: FolderId, _secret: str = Security(check_api_secret)):
-    folder_dir = ROOT_FOLDER / folder_id
-    if not os.path.exists(folder_dir):
+async def delete_folder(folder_id: FolderId, _secret: str = Security(check_api_secret)):
+    if not await bulk_io.run(remove_folder, folder_id):
         raise HTTPException(status_code=404, detail=f"Unknown folder '{folder_id}'")
-    shutil.rmtree(folder_dir)
-    try:
-        os.remove(ROOT_FOLDER / f"{folder_id}.zip")
-    except FileNotFoundError:
-        # Archive was never requested.
-        pass
-    try:
-        os.remove(ROOT_FOLDER / f"{folder_id}.md5")
-    except FileNotFoundError:
-        # No file added to the folder (md5 happens in hook).
-        pass
-    try:
-        os.remove(ROOT_FOLDER / f"{folder_id}.meta")
-    except FileNotFoundError:
-        # Folder was created with older version.
-        pass
-    print(f"Deleted folder '{folder_dir}'")
     return {}
 
 
+@app.post("/hooks")
+async def tusd_hook(hook: HookRequest):
+    """
+    Entry point for tusd's HTTP hooks (``-hooks-http``).
+    """
+    if hook.Type == "pre-create":
+        return await pre_create_hook(hook)
+    if hook.Type == "post-finish":
+        return await post_finish_hook(hook)
+    return {}
+
+
+@app.post("/hooks/pre-create")
+async def pre_create_hook(hook: HookRequest):
+    """
+    Check that the target folder exists before uploading.
+    """
+    return await fast_io.run(check_upload, hook.Event.Upload)
+
+
+@app.post("/hooks/post-finish")
+async def post_finish_hook(hook: HookRequest):
+    """
+    Move the uploaded file into its folder, unless it is a duplicate.
+    """
+    # Never rejected: tusd does not retry, the upload would be lost.
+    return await bulk_io.run(store_upload, hook.Event.Upload, reject=False)
+
+
 @app.get("/file/{folder_id}/{file_name}")
-def fetch_file(folder_id: FolderId, file_name: Filename):
-    folder_dir = ROOT_FOLDER / folder_id
+async def fetch_file(request: Request, folder_id: FolderId, file_name: Filename):
+    folder_dir = await fast_io.run(folder_path, folder_id)
     file = folder_dir / file_name
+    if not await fast_io.run(file.is_file):
+        raise HTTPException(status_code=404, detail=f"Unknown file '{file_name}'")
     headers = {"Content-Disposition": f'attachment; filename="{file_name}"'}
-    return FileResponse(file, headers=headers)
+    if SENDFILE_HEADER:
+        return sendfile_response(file, headers)
+    try:
+        opened = await fast_io.run(open, file, "rb")
+    except FileNotFoundError:
+        # Deleted in the meantime.
+        raise HTTPException(status_code=404, detail=f"Unknown file '{file_name}'")
+    media_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    return file_response(request, opened, headers, media_type)
+
+
+# Thumbnails being created, by path.
+thumbnail_jobs: dict[Path, asyncio.Future] = {}
+
+
+@app.get("/thumbnail/{folder_id}/{file_name}")
+async def get_thumbnail(
+    request: Request,
+    folder_id: FolderId,
+    file_name: Filename,
+    size: Annotated[int, Query()] = THUMBNAIL_DEFAULT_SIZE,
+):
+    """
+    Serve the thumbnail of the file, created on first request if missing.
+    """
+    if not THUMBNAILS_FOLDER:
+        raise HTTPException(status_code=404, detail="Thumbnails are disabled")
+    if size not in THUMBNAIL_SIZES:
+        raise HTTPException(
+            status_code=400, detail=f"Size must be one of {THUMBNAIL_SIZES}"
+        )
+    output = thumbnail_path(folder_id, file_name, size)
+    if not await fast_io.run(output.is_file):
+        source = await fast_io.run(folder_path, folder_id) / file_name
+        if thumbnailer is None or not await fast_io.run(source.is_file):
+            raise HTTPException(status_code=404, detail=f"Unknown file '{file_name}'")
+        # Concurrent requests for the same thumbnail wait for the same job.
+        if (job := thumbnail_jobs.get(output)) is None:
+            job = asyncio.ensure_future(
+                bulk_io.run(make_thumbnail, source, output, size)
+            )
+            thumbnail_jobs[output] = job
+            job.add_done_callback(lambda _: thumbnail_jobs.pop(output, None))
+        # Not cancelled if this client goes away.
+        if not await asyncio.shield(job):
+            raise HTTPException(
+                status_code=404, detail=f"Could not create thumbnail of '{file_name}'"
+            )
+    try:
+        opened = await fast_io.run(open, output, "rb")
+    except FileNotFoundError:
+        # Deleted in the meantime.
+        raise HTTPException(status_code=404, detail=f"Unknown file '{file_name}'")
+    headers = {"Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE_SECONDS}"}
+    return file_response(request, opened, headers, "image/jpeg")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        sys.exit(f"Usage: {sys.argv[0]} migrate")
+    migrate_folders()
@@ -1,12 +1,16 @@
 # tests/test_besace.py
+import asyncio
 import importlib
 import io
 import json
 import os
 import re
 import sys
+import threading
 import functools
+import hashlib
 import time
+import types
 import zipfile
 from pathlib import Path
 
@@ -29,18 +33,12 @@ def app_env(monkeypatch, tmp_path):
     monkeypatch.setenv("BESACE_ROOT_FOLDER", str(tmp_path))
     # Make purging easy to trigger in tests
     monkeypatch.setenv("BESACE_RETENTION_DAYS", "0")
-    # Don’t slow down 401 tests
-    monkeypatch.setenv("INVALID_SECRET_WAIT_SECONDS", "0")
-
     # Use small reveal length to assert metadata secret masking
     monkeypatch.setenv("LOG_SECRET_REVEAL_LENGTH", "3")
 
     # Ensure deterministic dictionary and folder name lengths
     monkeypatch.setenv("BESACE_CREATE_SECRETS", "s2cr2t,s3cr3t")
 
-    # No wait in bad auth
-    monkeypatch.setenv("BESACE_INVALID_SECRET_WAIT_SECONDS", "0")
-
     # Import *after* env is set:
     import main  # noqa: F401
 
@@ -91,6 +89,27 @@ def test_auth_bad_secret_is_401(client):
     assert res.json()["detail"] == "Invalid or missing API Secret"
 
 
+def test_auth_bad_secrets_are_rate_limited(client, app_env, auth_header):
+    app_env.INVALID_SECRET_BURST = 2
+
+    for _ in range(2):
+        res = client.post("/folder", headers={"Authorization": "Bearer WRONG"})
+        assert res.status_code == 401
+
+    res = client.post("/folder", headers={"Authorization": "Bearer WRONG"})
+    assert res.status_code == 429
+    assert 0 < int(res.headers["Retry-After"]) <= 60
+    # Valid secrets are refused too from this client.
+    res = client.post("/folder", headers=auth_header)
+    assert res.status_code == 429
+
+    # Attempts are given back over time.
+    app_env.INVALID_SECRET_REFILL_SECONDS = 0.01
+    time.sleep(0.02)
+    res = client.post("/folder", headers=auth_header)
+    assert res.status_code == 303
+
+
 def test_create_folder_redirects_and_writes_metadata(client, app_env, auth_header):
     # Force deterministic folder id by patching random.sample
     # The app uses 3 words; these short words also satisfy default min/max lengths.
@@ -133,7 +152,7 @@ def test_create_folder_redirects_and_writes_metadata(client, app_env, auth_heade
 
 
 def test_get_folder_lists_files_and_settings(client, app_env, auth_header):
-    # Create one folder via API (also exercises purge_old_folders with retention=0)
+    # Create one folder via API
     res = client.post("/folder", headers=auth_header)
     assert res.status_code == 303
     folder_url = res.headers["location"]
@@ -160,6 +179,118 @@ def test_get_folder_lists_files_and_settings(client, app_env, auth_header):
     assert [f["filename"] for f in body["files"]] == ["b.txt", "a.txt"]
 
 
+def test_get_folder_can_be_paginated(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    for i, name in enumerate(["a", "b", "c", "d", "e"]):
+        (folder / f"{name}.txt").write_text(name)
+        os.utime(folder / f"{name}.txt", (1000 + i // 2, 1000 + i // 2))
+
+    filenames = []
+    cursor = None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        body = client.get(f"/folder/{folder_id}", params=params).json()
+        filenames.extend(f["filename"] for f in body["files"])
+        if not (cursor := body["next_cursor"]):
+            break
+
+    assert filenames == ["e.txt", "c.txt", "d.txt", "a.txt", "b.txt"]
+    res = client.get(f"/folder/{folder_id}", params={"cursor": "$$$"})
+    assert res.status_code == 400
+
+
+def test_get_folder_can_be_streamed_as_ndjson(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "a.txt").write_text("A")
+    os.utime(folder / "a.txt", (1000, 1000))
+    (folder / "b.txt").write_text("BB")
+
+    res = client.get(f"/folder/{folder_id}", headers={"Accept": "application/x-ndjson"})
+
+    assert res.headers["content-type"] == "application/x-ndjson"
+    details, *files = [json.loads(line) for line in res.text.splitlines()]
+    assert details["folder"] == folder_id
+    assert details["next_cursor"] is None
+    assert "files" not in details
+    assert [(f["filename"], f["size"]) for f in files] == [("b.txt", 2), ("a.txt", 1)]
+
+
+def test_get_folder_reads_files_from_manifest(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "a.txt").write_text("A")
+    (folder / "b.txt").write_text("BB")
+    # Pretend last change is old enough to trust the manifest.
+    past = time.time_ns() - 60 * 1_000_000_000
+    os.utime(folder, ns=(past, past))
+
+    res = client.get(f"/folder/{folder_id}")
+    assert {f["filename"] for f in res.json()["files"]} == {"a.txt", "b.txt"}
+    assert (Path(app_env.ROOT_FOLDER) / f"{folder_id}.manifest").exists()
+
+    # Folder is not scanned again if unchanged.
+    (folder / "a.txt").unlink()
+    os.utime(folder, ns=(past, past))
+    res = client.get(f"/folder/{folder_id}")
+    assert {f["filename"] for f in res.json()["files"]} == {"a.txt", "b.txt"}
+
+    # Rescanned when folder changed.
+    (folder / "c.txt").write_text("CCC")
+    res = client.get(f"/folder/{folder_id}")
+    files = {f["filename"]: f["size"] for f in res.json()["files"]}
+    assert files == {"b.txt": 2, "c.txt": 3}
+
+
+def test_get_folder_supports_conditional_requests(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+
+    res = client.get(f"/folder/{folder_id}")
+    etag = res.headers["etag"]
+    res = client.get(f"/folder/{folder_id}", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+
+    # Other representation of the same version.
+    ndjson = {"Accept": "application/x-ndjson", "If-None-Match": etag}
+    res = client.get(f"/folder/{folder_id}", headers=ndjson)
+    assert res.status_code == 200
+    assert res.headers["etag"] != etag
+    ndjson["If-None-Match"] = res.headers["etag"]
+    assert client.get(f"/folder/{folder_id}", headers=ndjson).status_code == 304
+
+    (folder / "a.txt").write_text("A")
+    res = client.get(f"/folder/{folder_id}", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["etag"] != etag
+
+
+def test_folder_changes_since_version(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "a.txt").write_text("A")
+    version = client.get(f"/folder/{folder_id}").json()["version"]
+
+    # Nothing changed before timeout.
+    res = client.get(f"/folder/{folder_id}/changes?since={version}&timeout=0")
+    assert res.json() == {"version": version, "added": [], "removed": []}
+
+    (folder / "a.txt").unlink()
+    (folder / "b.txt").write_text("BB")
+    res = client.get(f"/folder/{folder_id}/changes?since={version}")
+    body = res.json()
+    assert body["version"] > version
+    assert [f["filename"] for f in body["added"]] == ["b.txt"]
+    assert body["removed"] == ["a.txt"]
+
+
 def test_download_archive_is_idempotent_and_has_disposition(
     client, app_env, auth_header
 ):
@@ -187,6 +318,316 @@ def test_download_archive_is_idempotent_and_has_disposition(
     assert names2 == {"x.bin", "y.bin"}
 
 
+def test_download_archive_deflates_a_window_of_files(
+    client, app_env, auth_header, monkeypatch
+):
+    monkeypatch.setattr(app_env, "ARCHIVE_COMPRESS_WINDOW", 3)
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    for i in range(20):
+        (folder / f"notes-{i:02}.txt").write_text(f"lorem ipsum {i} " * 1000)
+    deflated = []
+    written = []
+    in_flight = []
+    deflate_file = app_env.deflate_file
+    write_deflated = app_env.write_deflated
+
+    def counting_deflate_file(path, *args):
+        deflated.append(path.name)
+        in_flight.append(len(deflated) - len(written))
+        return deflate_file(path, *args)
+
+    def counting_write_deflated(archive, zinfo, data):
+        written.append(zinfo.filename)
+        write_deflated(archive, zinfo, data)
+
+    monkeypatch.setattr(app_env, "deflate_file", counting_deflate_file)
+    monkeypatch.setattr(app_env, "write_deflated", counting_write_deflated)
+
+    res = client.get(f"/folder/{folder_id}/download")
+
+    assert len(read_zip_names(res.content)) == 20
+    assert len(written) == 20
+    # Compressed files are never kept aside for the whole folder.
+    assert max(in_flight) <= 4
+
+
+@pytest.mark.parametrize("pre_deflated", [True, False])
+def test_download_archive_compresses_only_compressible_files(
+    client, app_env, auth_header, monkeypatch, pre_deflated
+):
+    if not pre_deflated:
+        # Unknown Python version: zipfile compresses the files itself.
+        monkeypatch.setattr(app_env, "ARCHIVE_PRE_DEFLATED_VERSIONS", ())
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "notes.txt").write_text("lorem ipsum " * 10000)
+    (folder / "café.pdf").write_bytes(b"%PDF-1.7 " * 1000)
+    (folder / "photo.jpg").write_bytes(b"jpeg" * 1000)
+    (folder / "random.bin").write_bytes(os.urandom(10000))
+    (folder / "tiny.txt").write_text("a")
+
+    res = client.get(f"/folder/{folder_id}/download")
+
+    with zipfile.ZipFile(io.BytesIO(res.content), "r") as zf:
+        assert zf.testzip() is None
+        compress_types = {info.filename: info.compress_type for info in zf.infolist()}
+        assert zf.read("notes.txt") == b"lorem ipsum " * 10000
+        assert zf.read("café.pdf") == b"%PDF-1.7 " * 1000
+    assert compress_types == {
+        "notes.txt": zipfile.ZIP_DEFLATED,
+        "café.pdf": zipfile.ZIP_DEFLATED,
+        "photo.jpg": zipfile.ZIP_STORED,
+        "random.bin": zipfile.ZIP_STORED,
+        "tiny.txt": zipfile.ZIP_STORED,
+    }
+
+    # New files are appended to the previous snapshot.
+    (folder / "more.txt").write_text("dolor sit amet " * 1000)
+    res = client.get(f"/folder/{folder_id}/download")
+
+    with zipfile.ZipFile(io.BytesIO(res.content), "r") as zf:
+        assert zf.testzip() is None
+        assert zf.getinfo("more.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert len(zf.namelist()) == 6
+
+
+def test_download_archive_updates_previous_snapshot_in_place(
+    client, app_env, auth_header
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    archive = Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip"
+    spare = Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.next"
+    (folder / "x.bin").write_bytes(os.urandom(10000))
+    first = client.get(f"/folder/{folder_id}/download").content
+    (folder / "y.bin").write_bytes(b"yyy")
+    second = client.get(f"/folder/{folder_id}/download").content
+    # The previous snapshot was copied once, and kept untouched.
+    assert spare.read_bytes() == first
+    spare_inode = spare.stat().st_ino
+
+    (folder / "z.bin").write_bytes(b"zzz")
+    res = client.get(f"/folder/{folder_id}/download")
+
+    # Only the missing files were appended to it, after its previous content.
+    assert archive.stat().st_ino == spare_inode
+    assert res.content.startswith(first)
+    assert read_zip_names(res.content) == {"x.bin", "y.bin", "z.bin"}
+    with zipfile.ZipFile(io.BytesIO(res.content), "r") as zf:
+        assert zf.testzip() is None
+    assert spare.read_bytes() == second
+    assert 0 < app_env.archive_waste(archive) < 0.1
+
+
+def test_download_archive_rebuilds_wasteful_snapshot(
+    client, app_env, auth_header, monkeypatch
+):
+    monkeypatch.setattr(app_env, "ARCHIVE_MAX_WASTE_RATIO", -1)
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    archive = Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip"
+    spare = Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.next"
+    for name in ("x.bin", "y.bin"):
+        (folder / name).write_bytes(name.encode())
+        client.get(f"/folder/{folder_id}/download")
+    spare_content = spare.read_bytes()
+
+    (folder / "z.bin").write_bytes(b"zzz")
+    with spare.open("rb") as previous:
+        client.get(f"/folder/{folder_id}/download")
+
+        # The spare was replaced by a copy of the snapshot.
+        assert os.fstat(previous.fileno()).st_nlink == 0
+        assert previous.read() == spare_content
+    assert app_env.archive_waste(archive) == 0
+    res = client.get(f"/folder/{folder_id}/download")
+    assert read_zip_names(res.content) == {"x.bin", "y.bin", "z.bin"}
+
+
+def test_download_archive_since_previous_download(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "x.bin").write_bytes(b"xxx")
+
+    res = client.get(f"/folder/{folder_id}/download")
+    assert read_zip_names(res.content) == {"x.bin"}
+    version = res.headers["x-folder-version"]
+
+    (folder / "y.bin").write_bytes(b"yyy")
+    res = client.get(f"/folder/{folder_id}/download", params={"since": version})
+
+    assert res.status_code == 200
+    assert read_zip_names(res.content) == {"y.bin"}
+    assert int(res.headers["content-length"]) == len(res.content)
+    assert res.headers["content-disposition"].endswith(f'{folder_id}-{version}.zip"')
+    assert int(res.headers["x-folder-version"]) > int(version)
+
+    # Nothing new.
+    version = res.headers["x-folder-version"]
+    res = client.get(f"/folder/{folder_id}/download", params={"since": version})
+    assert read_zip_names(res.content) == set()
+    # Unknown version (eg. folder was recreated).
+    res = client.get(f"/folder/{folder_id}/download", params={"since": 999})
+    assert read_zip_names(res.content) == {"x.bin", "y.bin"}
+
+
+def test_download_previous_archive_has_its_own_version(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "x.bin").write_bytes(b"xxx")
+    version = client.get(f"/folder/{folder_id}/download").headers["x-folder-version"]
+    (folder / "y.bin").write_bytes(b"yyy")
+
+    lock = app_env.FileLock(Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.lock")
+    with lock:
+        res = client.get(f"/folder/{folder_id}/download")
+
+    # y.bin is not in the served archive: it will be part of the next delta.
+    assert read_zip_names(res.content) == {"x.bin"}
+    assert res.headers["x-folder-version"] == version
+
+
+def test_download_archive_can_be_streamed(client, app_env, auth_header, monkeypatch):
+    monkeypatch.setattr(app_env, "ARCHIVE_MODE", "stream")
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "x.bin").write_bytes(b"xxx" * 1000)
+    (folder / "café.txt").write_text("crème")
+
+    res = client.get(f"/folder/{folder_id}/download")
+
+    assert res.status_code == 200
+    assert res.headers["content-disposition"].endswith(f'{folder_id}.zip"')
+    assert int(res.headers["content-length"]) == len(res.content)
+    with zipfile.ZipFile(io.BytesIO(res.content), "r") as zf:
+        assert zf.testzip() is None
+        assert set(zf.namelist()) == {"x.bin", "café.txt"}
+        assert zf.read("café.txt") == "crème".encode()
+    # Nothing was written on disk.
+    assert not (Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip").exists()
+
+
+def test_response_bodies_are_read_in_bulk_pool(
+    client, app_env, auth_header, monkeypatch
+):
+    threads = []
+
+    def spy(func):
+        def wrapper(*args):
+            threads.append(threading.current_thread().name)
+            return func(*args)
+
+        return wrapper
+
+    monkeypatch.setattr(app_env.os, "pread", spy(os.pread))
+    monkeypatch.setattr(app_env, "read_chunk", spy(app_env.read_chunk))
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (Path(app_env.ROOT_FOLDER) / folder_id / "x.bin").write_bytes(b"xxx")
+
+    assert client.get(f"/file/{folder_id}/x.bin").content == b"xxx"
+    assert client.get(f"/folder/{folder_id}/download").status_code == 200
+    monkeypatch.setattr(app_env, "ARCHIVE_MODE", "stream")
+    assert client.get(f"/folder/{folder_id}/download").status_code == 200
+
+    assert len(threads) == 3
+    assert all(name.startswith("besace-bulk") for name in threads)
+
+
+def test_download_serves_previous_snapshot_during_update(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "x.bin").write_bytes(b"xxx")
+    assert client.get(f"/folder/{folder_id}/download").status_code == 200
+
+    (folder / "y.bin").write_bytes(b"yyy")
+    lock = app_env.FileLock(Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.lock")
+    with lock.acquire():
+        # Another worker is updating the archive: previous version is served.
+        res = client.get(f"/folder/{folder_id}/download")
+        assert res.status_code == 200
+        assert read_zip_names(res.content) == {"x.bin"}
+
+    res = client.get(f"/folder/{folder_id}/download")
+    assert read_zip_names(res.content) == {"x.bin", "y.bin"}
+    assert not (Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.previous").exists()
+
+
+def test_download_empty_folder(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+
+    res = client.get(f"/folder/{folder_id}/download")
+
+    assert res.status_code == 200
+    assert read_zip_names(res.content) == set()
+
+
+def test_download_fails_if_first_archive_is_locked(
+    client, app_env, auth_header, monkeypatch
+):
+    monkeypatch.setattr(app_env, "LOCK_TIMEOUT_SECONDS", 0)
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (Path(app_env.ROOT_FOLDER) / folder_id / "x.bin").write_bytes(b"xxx")
+
+    lock = app_env.FileLock(Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.lock")
+    with lock.acquire():
+        res = client.get(f"/folder/{folder_id}/download")
+
+    assert res.status_code == 503
+
+
+def test_archive_is_built_in_background(app_env, auth_header, monkeypatch):
+    monkeypatch.setattr(app_env.archive_builder, "delay", 0)
+    # Run lifespan, to start the builder on the event loop.
+    with TestClient(app_env.app, follow_redirects=False) as client:
+        res = client.post("/folder", headers=auth_header)
+        folder_id = res.headers["location"].rsplit("/", 1)[-1]
+        folder = Path(app_env.ROOT_FOLDER) / folder_id
+        (folder / "x.bin").write_bytes(b"xxx")
+
+        # Scheduled when uploads are finished.
+        app_env.archive_builder.schedule(folder_id)
+
+        archive = Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip"
+        lock = app_env.FileLock(Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip.lock")
+        for _ in range(100):
+            if archive.exists():
+                break
+            time.sleep(0.01)
+        with lock.acquire(timeout=5):
+            assert read_zip_names(archive.read_bytes()) == {"x.bin"}
+
+
+def test_archive_builds_are_debounced(app_env, monkeypatch):
+    built = []
+    monkeypatch.setattr(app_env, "update_folder_archive", built.append)
+    (Path(app_env.ROOT_FOLDER) / "oak-lime-pine").mkdir()
+    builder = app_env.ArchiveBuilder(delay=0.1, concurrency=1)
+
+    async def uploads():
+        builder.start()
+        builder.schedule("oak-lime-pine")
+        builder.schedule("oak-lime-pine")
+        builder.schedule("oak-lime-pine")
+        await asyncio.sleep(0.3)
+
+    asyncio.run(uploads())
+
+    assert built == ["oak-lime-pine"]
+    assert not builder.tasks and not builder.running
+
+
 def test_fetch_file_returns_attachment(client, app_env, auth_header):
     res = client.post("/folder", headers=auth_header)
     assert res.status_code == 303
@@ -200,6 +641,99 @@ def test_fetch_file_returns_attachment(client, app_env, auth_header):
     assert res.text == "# hello"
 
 
+def test_metrics_are_exposed(app_env, auth_header):
+    root = Path(app_env.ROOT_FOLDER)
+    (root / "old-folder-here").mkdir()
+    (root / "old-folder-here" / "a.txt").write_text("abc")
+
+    # Run lifespan, to measure storage on startup.
+    with TestClient(app_env.app, follow_redirects=False) as client:
+        res = client.post("/folder", headers=auth_header)
+        folder_id = res.headers["location"].rsplit("/", 1)[-1]
+        client.get("/file/old-folder-here/a.txt")
+        client.get(f"/folder/{folder_id}/download")
+        res = client.get("/metrics")
+
+    assert res.status_code == 200
+    metrics = res.text
+    assert (
+        'besace_requests_total{method="POST",route="create_folder",status="303"} 1.0'
+        in metrics
+    )
+    assert 'besace_request_duration_seconds_count{route="fetch_file"} 1.0' in metrics
+    assert 'besace_response_bytes_total{route="fetch_file"} 3.0' in metrics
+    assert "besace_archive_lock_wait_seconds_count 1.0" in metrics
+    assert "besace_folders 2.0" in metrics
+    assert "besace_stored_bytes 3.0" in metrics
+
+
+def test_fetch_file_supports_ranges(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (Path(app_env.ROOT_FOLDER) / folder_id / "video.mp4").write_bytes(b"0123456789")
+
+    res = client.get(f"/file/{folder_id}/video.mp4", headers={"Range": "bytes=2-5"})
+    assert res.status_code == 206
+    assert res.content == b"2345"
+
+    res = client.get(f"/file/{folder_id}/missing.mp4")
+    assert res.status_code == 404
+
+
+def test_download_archive_supports_ranges(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (Path(app_env.ROOT_FOLDER) / folder_id / "x.bin").write_bytes(b"x" * 1000)
+    full = client.get(f"/folder/{folder_id}/download")
+    etag = full.headers["etag"]
+
+    res = client.get(
+        f"/folder/{folder_id}/download",
+        headers={"Range": "bytes=100-", "If-Range": etag},
+    )
+    assert res.status_code == 206
+    assert res.content == full.content[100:]
+    assert (
+        res.headers["content-range"]
+        == f"bytes 100-{len(full.content) - 1}/{len(full.content)}"
+    )
+
+    res = client.get(f"/folder/{folder_id}/download", headers={"Range": "bytes=-10"})
+    assert res.content == full.content[-10:]
+
+    # Archive has changed since.
+    res = client.get(
+        f"/folder/{folder_id}/download",
+        headers={"Range": "bytes=100-", "If-Range": '"other"'},
+    )
+    assert res.status_code == 200
+    assert res.content == full.content
+
+    res = client.get(f"/folder/{folder_id}/download", headers={"Range": "bytes=99999-"})
+    assert res.status_code == 416
+
+
+def test_downloads_can_be_offloaded_to_reverse_proxy(
+    client, app_env, auth_header, monkeypatch
+):
+    monkeypatch.setattr(app_env, "SENDFILE_HEADER", "X-Accel-Redirect")
+    monkeypatch.setattr(app_env, "SENDFILE_PREFIX", "/internal-uploads/")
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (Path(app_env.ROOT_FOLDER) / folder_id / "my photo.jpg").write_bytes(b"x")
+
+    res = client.get(f"/file/{folder_id}/my photo.jpg")
+    assert res.headers["x-accel-redirect"] == (
+        f"/internal-uploads/{folder_id}/my%20photo.jpg"
+    )
+    assert res.headers["content-disposition"].endswith('my photo.jpg"')
+    assert res.content == b""
+
+    res = client.get(f"/folder/{folder_id}/download")
+    assert res.headers["x-accel-redirect"] == f"/internal-uploads/{folder_id}.zip"
+    assert (Path(app_env.ROOT_FOLDER) / f"{folder_id}.zip").exists()
+
+
 def test_delete_folder_removes_dir_and_artifacts(client, app_env, auth_header):
     # Create folder and trigger archive creation so .zip exists
     res = client.post("/folder", headers=auth_header)
@@ -222,6 +756,279 @@ def test_delete_folder_removes_dir_and_artifacts(client, app_env, auth_header):
     # .md5 may or may not exist; delete path is covered by API
 
 
+def test_bulk_jobs_are_rejected_when_pool_is_saturated(
+    client, app_env, auth_header, monkeypatch
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (Path(app_env.ROOT_FOLDER) / folder_id / "t.txt").write_text("t")
+    bulk_io = app_env.IOPool("bulk", workers=1, backlog=0)
+    monkeypatch.setattr(app_env, "bulk_io", bulk_io)
+    # Simulate a long running job.
+    bulk_io.slots.acquire()
+
+    res = client.delete(f"/folder/{folder_id}", headers=auth_header)
+    assert res.status_code == 503
+    assert res.headers["retry-after"] == "5"
+    res = client.get(f"/folder/{folder_id}/download")
+    assert res.status_code == 503
+
+    # Light requests are not affected.
+    res = client.get(f"/folder/{folder_id}")
+    assert res.status_code == 200
+
+    bulk_io.slots.release()
+    res = client.delete(f"/folder/{folder_id}", headers=auth_header)
+    assert res.status_code == 200
+
+
+def test_purge_deletes_expired_folders_from_index(client, app_env, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    root = Path(app_env.ROOT_FOLDER)
+    index = [json.loads(line) for line in (root / ".expiry").read_text().splitlines()]
+    assert index == [{"created": index[0]["created"], "folder": folder_id}]
+
+    app_env.purge_old_folders()
+    assert (root / folder_id).exists()
+
+    two_days_ago = int(time.time()) - 2 * 24 * 3600
+    app_env.write_expiry_index([(two_days_ago, folder_id)])
+    app_env.purge_old_folders()
+
+    assert not (root / folder_id).exists()
+    assert (root / ".expiry").read_text() == ""
+
+
+def test_purge_rebuilds_missing_index(app_env):
+    root = Path(app_env.ROOT_FOLDER)
+    (root / "oak-lime-pine").mkdir()
+    two_days_ago = int(time.time()) - 2 * 24 * 3600
+    (root / "oak-lime-pine.meta").write_text(json.dumps({"created": two_days_ago}))
+
+    app_env.purge_old_folders()
+
+    assert not (root / "oak-lime-pine").exists()
+    assert (root / ".expiry").exists()
+
+
+def test_purge_is_skipped_if_running_elsewhere(app_env):
+    root = Path(app_env.ROOT_FOLDER)
+    (root / "oak-lime-pine").mkdir()
+    two_days_ago = int(time.time()) - 2 * 24 * 3600
+    (root / "oak-lime-pine.meta").write_text(json.dumps({"created": two_days_ago}))
+
+    with app_env.FileLock(root / ".purge.lock"):
+        app_env.purge_old_folders()
+
+    assert (root / "oak-lime-pine").exists()
+
+
+def hook_payload(hook_type, folder_id, filename, upload_id="abc123"):
+    return {
+        "Type": hook_type,
+        "Event": {
+            "Upload": {
+                "ID": upload_id,
+                "Size": 3,
+                "MetaData": {"folderId": folder_id, "filename": filename},
+                "Storage": {"Type": "filestore", "Path": f"/elsewhere/{upload_id}"},
+            },
+            "HTTPRequest": {"Method": "POST", "URI": "/files/"},
+        },
+    }
+
+
+@pytest.fixture()
+def incoming(app_env, tmp_path, monkeypatch):
+    folder = tmp_path / "incoming"
+    folder.mkdir()
+    monkeypatch.setattr(app_env, "INCOMING_FOLDER", folder)
+    return folder
+
+
+def test_pre_create_hook_checks_folder(client, auth_header):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+
+    res = client.post("/hooks", json=hook_payload("pre-create", folder_id, "a.jpg"))
+    assert res.json() == {}
+
+    res = client.post(
+        "/hooks/pre-create", json=hook_payload("pre-create", "oak-lime-pine", "a.jpg")
+    )
+    assert res.json()["RejectUpload"]
+    assert res.json()["HTTPResponse"]["StatusCode"] == 404
+
+    res = client.post(
+        "/hooks/pre-create", json=hook_payload("pre-create", "../etc", "a.jpg")
+    )
+    assert res.json()["HTTPResponse"]["StatusCode"] == 400
+
+
+def test_pre_create_hook_rejects_known_hashes(client, app_env, auth_header, incoming):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (incoming / "u1").write_bytes(b"aaa")
+    client.post("/hooks", json=hook_payload("post-finish", folder_id, "a.jpg", "u1"))
+
+    payload = hook_payload("pre-create", folder_id, "copy.jpg")
+    payload["Event"]["Upload"]["MetaData"]["md5"] = "47BCE5C74F589F4867DBD57E9CA9F808"
+    res = client.post("/hooks", json=payload)
+    assert res.json()["RejectUpload"]
+    assert res.json()["HTTPResponse"]["StatusCode"] == 409
+    assert "copy.jpg" in res.json()["HTTPResponse"]["Body"]
+
+    payload["Event"]["Upload"]["MetaData"]["md5"] = "00000000000000000000000000000000"
+    assert client.post("/hooks", json=payload).json() == {}
+
+
+def test_post_finish_hook_does_not_trust_announced_hash(
+    client, app_env, auth_header, incoming
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    (incoming / "u1").write_bytes(b"aaa")
+    payload = hook_payload("post-finish", folder_id, "a.jpg", "u1")
+    payload["Event"]["Upload"]["MetaData"]["md5"] = "00000000000000000000000000000000"
+
+    client.post("/hooks", json=payload)
+
+    assert app_env.known_hashes(folder_id) == {"47bce5c74f589f4867dbd57e9ca9f808"}
+
+
+def test_post_finish_hook_ignores_folder_deleted_meanwhile(
+    client, app_env, auth_header, incoming, monkeypatch
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    root = Path(app_env.ROOT_FOLDER)
+    stage_upload = app_env.stage_upload
+
+    def delete_while_staging(source):
+        assert app_env.remove_folder(folder_id)
+        return stage_upload(source)
+
+    monkeypatch.setattr(app_env, "stage_upload", delete_while_staging)
+    (incoming / "u1").write_bytes(b"aaa")
+    (incoming / "u1.info").write_text("{}")
+
+    payload = hook_payload("post-finish", folder_id, "a.jpg", "u1")
+    assert client.post("/hooks", json=payload).json() == {}
+
+    assert not (root / folder_id).exists()
+    assert not (root / f"{folder_id}.md5").exists()
+    assert not (root / f"{folder_id}.manifest").exists()
+    assert not list(root.glob(".*.upload"))
+    assert folder_id not in app_env.folders_hashes
+
+
+def test_post_finish_hook_moves_files_and_ignores_duplicates(
+    client, app_env, auth_header, incoming
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+
+    def upload(upload_id, filename, content):
+        (incoming / upload_id).write_bytes(content)
+        (incoming / f"{upload_id}.info").write_text("{}")
+        payload = hook_payload("post-finish", folder_id, filename, upload_id)
+        assert client.post("/hooks", json=payload).json() == {}
+        assert not (incoming / upload_id).exists()
+        assert not (incoming / f"{upload_id}.info").exists()
+
+    upload("u1", "a.jpg", b"aaa")
+    upload("u2", "a.jpg", b"bbb")
+    upload("u3", "c.jpg", b"aaa")  # Duplicate of u1.
+
+    assert sorted(p.name for p in folder.iterdir()) == ["a (2).jpg", "a.jpg"]
+    assert (folder / "a (2).jpg").read_bytes() == b"bbb"
+    assert len(app_env.known_hashes(folder_id)) == 2
+    # The hashes are recorded along the final filenames (for the thumbnailer).
+    lines = (Path(app_env.ROOT_FOLDER) / f"{folder_id}.md5").read_text().splitlines()
+    assert f"{hashlib.md5(b'bbb').hexdigest()}  a (2).jpg" in lines
+    files = client.get(f"/folder/{folder_id}").json()["files"]
+    assert {f["filename"] for f in files} == {"a.jpg", "a (2).jpg"}
+
+
+def test_post_finish_hook_reads_hashes_appended_elsewhere(
+    client, app_env, auth_header, incoming
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    md5file = Path(app_env.ROOT_FOLDER) / f"{folder_id}.md5"
+    assert app_env.known_hashes(folder_id) == set()
+
+    # Another worker received this file.
+    md5file.write_text("47bce5c74f589f4867dbd57e9ca9f808\n")
+    (incoming / "u1").write_bytes(b"aaa")
+
+    client.post("/hooks", json=hook_payload("post-finish", folder_id, "a.jpg", "u1"))
+
+    assert list((Path(app_env.ROOT_FOLDER) / folder_id).iterdir()) == []
+
+
+def test_folders_can_be_sharded(client, app_env, auth_header, incoming, monkeypatch):
+    monkeypatch.setattr(app_env, "SHARD_LEVELS", 2)
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    root = Path(app_env.ROOT_FOLDER)
+    digest = hashlib.md5(folder_id.encode()).hexdigest()
+    shard = root / digest[:2] / digest[2:4]
+    assert (shard / folder_id).is_dir()
+    assert (shard / f"{folder_id}.meta").exists()
+    assert not (root / folder_id).exists()
+
+    (incoming / "u1").write_bytes(b"aaa")
+    client.post("/hooks", json=hook_payload("post-finish", folder_id, "a.jpg", "u1"))
+
+    assert (shard / folder_id / "a.jpg").exists()
+    assert (shard / f"{folder_id}.md5").exists()
+    files = client.get(f"/folder/{folder_id}").json()["files"]
+    assert [f["filename"] for f in files] == ["a.jpg"]
+    res = client.get(f"/folder/{folder_id}/download")
+    assert read_zip_names(res.content) == {"a.jpg"}
+    assert (shard / f"{folder_id}.zip").exists()
+    assert app_env.read_expiry_index()[0][1] == folder_id
+
+    client.delete(f"/folder/{folder_id}", headers=auth_header)
+    assert sorted(p.name for p in shard.iterdir() if not p.name.endswith(".lock")) == []
+
+
+def test_folders_can_be_migrated_to_sharded_layout(
+    client, app_env, auth_header, monkeypatch
+):
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    root = Path(app_env.ROOT_FOLDER)
+    (root / folder_id / "a.txt").write_text("A")
+    client.get(f"/folder/{folder_id}/download")
+
+    monkeypatch.setattr(app_env, "SHARD_LEVELS", 2)
+    # Folders of the flat layout are still served.
+    res = client.get(f"/folder/{folder_id}")
+    assert [f["filename"] for f in res.json()["files"]] == ["a.txt"]
+
+    app_env.migrate_folders()
+
+    shard = app_env.shard_dir(folder_id)
+    assert shard != root
+    assert (shard / folder_id / "a.txt").exists()
+    assert sorted(p.name for p in shard.iterdir() if not p.name.endswith(".lock")) == [
+        folder_id,
+        f"{folder_id}.manifest",
+        f"{folder_id}.meta",
+        f"{folder_id}.zip",
+    ]
+    assert sorted(p.name for p in root.iterdir() if p.name.startswith(folder_id)) == []
+    res = client.get(f"/folder/{folder_id}")
+    assert res.json()["created"] > 0
+    assert [f["filename"] for f in res.json()["files"]] == ["a.txt"]
+    res = client.get(f"/folder/{folder_id}/download")
+    assert read_zip_names(res.content) == {"a.txt"}
+
+
 def test_validation_bad_folder_id_yields_422(client):
     # Fails FolderIdValidator (non-matching pattern)
     res = client.get("/folder/NOPE_not-valid")
@@ -246,3 +1053,54 @@ def test_unauthorized_delete_is_401(client):
     )
     assert res.status_code == 401
     assert res.json()["detail"] == "Invalid or missing API Secret"
+
+
+def test_thumbnails_are_created_on_demand(
+    client, app_env, auth_header, monkeypatch, tmp_path
+):
+    thumbnails = tmp_path / "thumbnails"
+    monkeypatch.setattr(app_env, "THUMBNAILS_FOLDER", str(thumbnails))
+    created = []
+
+    def create_thumbnail(input_path, output_path, size, frame_time):
+        created.append((Path(input_path).name, size))
+        if not input_path.endswith(".broken"):
+            Path(output_path).write_bytes(b"JPEG")
+
+    monkeypatch.setattr(
+        app_env, "thumbnailer", types.SimpleNamespace(create_thumbnail=create_thumbnail)
+    )
+    res = client.post("/folder", headers=auth_header)
+    folder_id = res.headers["location"].rsplit("/", 1)[-1]
+    folder = Path(app_env.ROOT_FOLDER) / folder_id
+    (folder / "a.png").write_bytes(b"PNG")
+    (folder / "b.broken").write_bytes(b"???")
+
+    res = client.get(f"/thumbnail/{folder_id}/a.png")
+    assert res.status_code == 200
+    assert res.content == b"JPEG"
+    assert res.headers["content-type"] == "image/jpeg"
+    assert "max-age" in res.headers["cache-control"]
+    # Stored like the thumbnailer does.
+    assert (thumbnails / folder_id / "a.png.jpg").read_bytes() == b"JPEG"
+
+    # Served from cache.
+    res = client.get(f"/thumbnail/{folder_id}/a.png")
+    assert res.status_code == 200
+    assert created == [("a.png", (256, 256))]
+
+    res = client.get(f"/thumbnail/{folder_id}/a.png", params={"size": 128})
+    assert res.status_code == 200
+    assert (thumbnails / folder_id / "128px" / "a.png.jpg").exists()
+    assert client.get(f"/thumbnail/{folder_id}/a.png?size=300").status_code == 400
+
+    assert client.get(f"/thumbnail/{folder_id}/b.broken").status_code == 404
+    assert client.get(f"/thumbnail/{folder_id}/unknown.png").status_code == 404
+    # No leftover of failed thumbnails.
+    assert sorted(p.name for p in (thumbnails / folder_id).iterdir()) == [
+        "128px",
+        "a.png.jpg",
+    ]
+
+    client.delete(f"/folder/{folder_id}", headers=auth_header)
+    assert not (thumbnails / folder_id).exists()
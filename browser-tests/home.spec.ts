@@ -107,10 +107,15 @@ test("can see thumbnails", async ({ page, context }) => {
   await page.click("#preview");
 
   // Wait for any lazy loaded images to finish.
-  await page.waitForLoadState("networkidle");
+  // (not "networkidle", since the page long-polls the folder changes)
+  await page.waitForSelector(".gallery img");
+  await page.waitForFunction(() =>
+    Array.from(document.querySelectorAll<HTMLImageElement>(".gallery img")).every(
+      (img) => img.complete && img.naturalWidth > 0
+    )
+  );
 
   // Check that there are no broken images in the gallery
-  await page.waitForSelector(".gallery img");
   const brokenCount = await page.$$eval(
     ".gallery img",
     (imgs) =>
@@ -4,6 +4,7 @@ import {
   Tus,
   Uppy,
 } from "./vendored/uppy-v3.25.2.min.mjs";
+import { md5 } from "./md5.mjs";
 dayjs.extend(dayjs_plugin_relativeTime);
 
 function humanFileSize(size) {
@@ -15,8 +16,27 @@ function humanFileSize(size) {
   );
 }
 
+// Read a stream of JSON lines, by batches of parsed objects.
+async function* readNdjson(stream) {
+  const reader = stream.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    const lines = (buffer + value).split("\n");
+    buffer = lines.pop();
+    yield lines.filter(Boolean).map((line) => JSON.parse(line));
+  }
+  if (buffer.trim()) {
+    yield [JSON.parse(buffer)];
+  }
+}
+
 window.addEventListener("load", async (e) => {
   let details;
+  let listing;
 
   const folderId = window.location.hash.slice(1);
   if (!folderId) {
@@ -45,7 +65,10 @@ window.addEventListener("load", async (e) => {
       }
     }
   } else {
-    const respRaw = await fetch(`/api/folder/${folderId}`);
+    // Files are streamed one per line, to render big folders early.
+    const respRaw = await fetch(`/api/folder/${folderId}`, {
+      headers: { Accept: "application/x-ndjson" },
+    });
     if (respRaw.status >= 400) {
       document.getElementById(
         "title",
@@ -53,20 +76,53 @@ window.addEventListener("load", async (e) => {
       // Exit UI load.
       return;
     }
-    details = await respRaw.json();
+    listing = readNdjson(respRaw.body);
+    const received = [];
+    while (!received.length) {
+      const { value, done } = await listing.next();
+      if (done) {
+        break;
+      }
+      received.push(...value);
+    }
+    // First line has the folder details.
+    details = { ...received.shift(), files: received };
   }
 
   document.getElementById("title").textContent = details.folder;
 
   const btnDownload = document.getElementById("download");
-  btnDownload.disabled = !details.files.length;
-  const size = details.files.reduce((acc, f) => {
-    acc += f.size;
-    return acc;
-  }, 0);
-  btnDownload.querySelector("#download-label").innerHTML = `Download ${
-    details.files.length
-  } file${details.files.length > 1 ? "s" : ""} <br/> (${humanFileSize(size)})`;
+  const btnPreview = document.getElementById("preview");
+  function refreshToolbar() {
+    btnDownload.disabled = !details.files.length;
+    btnPreview.disabled = !details.files.length;
+    const size = details.files.reduce((acc, f) => {
+      acc += f.size;
+      return acc;
+    }, 0);
+    btnDownload.querySelector("#download-label").innerHTML = `Download ${
+      details.files.length
+    } file${details.files.length > 1 ? "s" : ""} <br/> (${humanFileSize(size)})`;
+
+    if (details.files.length) {
+      const lastUpdate = new Date(details.files[0].modified * 1000);
+      const lastUpdateElt = document.getElementById("last-update");
+      lastUpdateElt.setAttribute("title", lastUpdate.toLocaleDateString());
+      lastUpdateElt.textContent = `Last upload: ${dayjs(lastUpdate).fromNow()}`;
+    }
+  }
+  refreshToolbar();
+
+  const filesLoaded = (async () => {
+    if (!listing) {
+      return;
+    }
+    for await (const files of listing) {
+      details.files.push(...files);
+      refreshToolbar();
+    }
+  })();
+
   btnDownload.addEventListener("click", (e) => {
     window.location = `/api/folder/${details.folder}/download`;
   });
@@ -86,8 +142,6 @@ window.addEventListener("load", async (e) => {
     }
   });
 
-  const btnPreview = document.getElementById("preview");
-  btnPreview.disabled = !details.files.length;
   btnPreview.addEventListener("click", (e) => {
     // Group by upload
     const minimumIntervalSeconds = 3600 * 3; // 3H between groups.
@@ -142,18 +196,11 @@ window.addEventListener("load", async (e) => {
       });
   });
 
-  if (details.files.length) {
-    const lastUpdate = new Date(details.files[0].modified * 1000);
-    const lastUpdateElt = document.getElementById("last-update");
-    lastUpdateElt.setAttribute("title", lastUpdate.toLocaleDateString());
-    lastUpdateElt.textContent = `Last upload: ${dayjs(lastUpdate).fromNow()}`;
-  }
-
   const folderCreated = new Date(details.created * 1000);
   const folderExpires = new Date(
     (details.created + details.settings.retention_days * 3600 * 24) * 1000,
   );
-  const uppyNote = `This Besace temporary shared folder contains ${
+  const uppyNote = () => `This Besace temporary shared folder contains ${
     details.files.length
   } file${details.files.length > 1 ? "s" : ""}. It was created ${dayjs(
     folderCreated,
@@ -179,7 +226,7 @@ window.addEventListener("load", async (e) => {
       target: "#uppy",
       height: document.getElementById("uppy").offsetHeight - 30,
       width: document.getElementById("uppy").offsetWidth,
-      note: uppyNote,
+      note: uppyNote(),
       locale: {
         strings: {
           browseFiles: "upload files",
@@ -191,12 +238,41 @@ window.addEventListener("load", async (e) => {
     .use(Tus, {
       endpoint: window.location.href.split("#")[0] + "tusd",
     });
-  uppy.on("complete", async (result) => {
-    // If successful, wait and refresh.
-    if (result.failed.length == 0) {
-      setTimeout(() => window.location.reload(), 1000);
+  // Send the hash of files, so that duplicates are rejected before upload.
+  uppy.addPreProcessor(async (fileIDs) => {
+    for (const fileID of fileIDs) {
+      const file = uppy.getFile(fileID);
+      uppy.setFileMeta(fileID, { md5: await md5(file.data) });
     }
   });
+
+  await filesLoaded;
+  uppy.getPlugin("Dashboard").setOptions({ note: uppyNote() });
+
+  // Keep the list of files up to date (long-polling of changes).
+  while (true) {
+    try {
+      const respRaw = await fetch(
+        `/api/folder/${details.folder}/changes?since=${details.version}`,
+      );
+      if (respRaw.status >= 400) {
+        break;
+      }
+      const changes = await respRaw.json();
+      const changed = new Set([
+        ...changes.removed,
+        ...changes.added.map((f) => f.filename),
+      ]);
+      details.files = changes.added
+        .concat(details.files.filter((f) => !changed.has(f.filename)))
+        .sort((a, b) => b.modified - a.modified);
+      details.version = changes.version;
+      refreshToolbar();
+    } catch (e) {
+      // Network error, retry later.
+      await new Promise((resolve) => setTimeout(resolve, 5000));
+    }
+  }
 });
 
 
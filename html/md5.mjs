@@ -0,0 +1,97 @@
+// Minimal incremental MD5, used to detect duplicate files before uploading
+// them (WebCrypto does not offer MD5).
+
+const SHIFTS = [7, 12, 17, 22, 5, 9, 14, 20, 4, 11, 16, 23, 6, 10, 15, 21];
+const CONSTANTS = new Int32Array(64).map((_, i) =>
+  Math.floor(Math.abs(Math.sin(i + 1)) * 2 ** 32),
+);
+const CHUNK_SIZE = 4 * 1024 * 1024;
+
+class MD5 {
+  constructor() {
+    this.state = new Int32Array([
+      0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476,
+    ]);
+    this.buffer = new Uint8Array(64);
+    this.buffered = 0;
+    this.length = 0;
+  }
+
+  transform(block) {
+    const view = new DataView(block.buffer, block.byteOffset, 64);
+    let [a, b, c, d] = this.state;
+    for (let i = 0; i < 64; i++) {
+      let f, g;
+      if (i < 16) {
+        f = (b & c) | (~b & d);
+        g = i;
+      } else if (i < 32) {
+        f = (d & b) | (~d & c);
+        g = (5 * i + 1) % 16;
+      } else if (i < 48) {
+        f = b ^ c ^ d;
+        g = (3 * i + 5) % 16;
+      } else {
+        f = c ^ (b | ~d);
+        g = (7 * i) % 16;
+      }
+      const x = (a + f + CONSTANTS[i] + view.getInt32(g * 4, true)) | 0;
+      const s = SHIFTS[(i >> 4) * 4 + (i % 4)];
+      a = d;
+      d = c;
+      c = b;
+      b = (b + ((x << s) | (x >>> (32 - s)))) | 0;
+    }
+    this.state[0] += a;
+    this.state[1] += b;
+    this.state[2] += c;
+    this.state[3] += d;
+  }
+
+  update(bytes) {
+    this.length += bytes.length;
+    let offset = 0;
+    if (this.buffered) {
+      offset = Math.min(64 - this.buffered, bytes.length);
+      this.buffer.set(bytes.subarray(0, offset), this.buffered);
+      this.buffered += offset;
+      if (this.buffered < 64) {
+        return;
+      }
+      this.transform(this.buffer);
+      this.buffered = 0;
+    }
+    for (; offset + 64 <= bytes.length; offset += 64) {
+      this.transform(bytes.subarray(offset, offset + 64));
+    }
+    this.buffer.set(bytes.subarray(offset), 0);
+    this.buffered = bytes.length - offset;
+  }
+
+  hexdigest() {
+    const bits = this.length * 8;
+    const padding = new Uint8Array(
+      (this.buffered < 56 ? 56 : 120) - this.buffered + 8,
+    );
+    padding[0] = 0x80;
+    const view = new DataView(padding.buffer);
+    view.setUint32(padding.length - 8, bits >>> 0, true);
+    view.setUint32(padding.length - 4, Math.floor(bits / 2 ** 32), true);
+    this.update(padding);
+    const digest = new DataView(this.state.buffer);
+    let hex = "";
+    for (let i = 0; i < 16; i++) {
+      hex += digest.getUint8(i).toString(16).padStart(2, "0");
+    }
+    return hex;
+  }
+}
+
+export async function md5(blob) {
+  const hash = new MD5();
+  for (let offset = 0; offset < blob.size; offset += CHUNK_SIZE) {
+    const chunk = blob.slice(offset, offset + CHUNK_SIZE);
+    hash.update(new Uint8Array(await chunk.arrayBuffer()));
+  }
+  return hash.hexdigest();
+}
@@ -2,11 +2,16 @@
 import importlib
 import io
 import os
+import pickle
+import shutil
+import struct
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 import types
 import time
-import numpy as np
 
 import pytest
 from PIL import Image
@@ -18,41 +23,68 @@ if str(_PROJECT_ROOT) not in sys.path:
 
 
 class DummyEvent:
-    def __init__(self, src_path: str, is_directory: bool):
+    def __init__(self, src_path: str, is_directory: bool, dest_path: str = ""):
         self.src_path = src_path
         self.is_directory = is_directory
+        self.dest_path = dest_path
 
 
-class DummyVideoFileClip:
-    def __init__(self, path):
-        # Simulate a short clip
-        self.path = path
-        self.duration = 3.7
+class DummyStream:
+    def __init__(self, *args, **kwargs):
+        self.args = ["ffmpeg", "-i", *args, *(f"-{k}" for k in kwargs)]
+
+    def filter(self, *args, **kwargs):
+        return self
+
+    def output(self, *args, **kwargs):
+        return self
 
-    def get_frame(self, t):
-        # Return a tiny RGB **NumPy array** as a frame (what Image.fromarray expects)
-        return np.asarray(Image.new("RGB", (16, 9), color=(10, 20, 30)))
+    def compile(self):
+        return self.args
 
 
 class DummyPix:
     def __init__(self, w=20, h=30):
         self.width = w
         self.height = h
+        self.stride = w * 3
         # simple gray buffer
-        self.samples = bytes([180] * (w * h * 3))
+        self.samples_mv = memoryview(bytes([180] * (w * h * 3)))
+
+
+class DummyRect:
+    def __init__(self, w, h):
+        self.width = w
+        self.height = h
 
 
 class DummyPage:
-    def get_pixmap(self):
-        return DummyPix()
+    def __init__(self, w=20, h=30):
+        self.rect = DummyRect(w, h)
+
+    def get_pixmap(self, matrix, alpha):
+        scale_x, scale_y = matrix
+        return DummyPix(
+            round(self.rect.width * scale_x), round(self.rect.height * scale_y)
+        )
 
 
 class DummyDoc:
+    page_size = (20, 30)
+
     def __init__(self, path):
         self.path = path
+        self.closed = False
+        DummyDoc.last = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
 
     def load_page(self, _index):
-        return DummyPage()
+        return DummyPage(*self.page_size)
 
 
 @pytest.fixture()
@@ -64,16 +96,18 @@ def stub_deps(monkeypatch):
     # pillow_heif.register_heif_opener
     ph = types.ModuleType("pillow_heif")
     ph.register_heif_opener = lambda: None
+    ph.thumbnail = lambda im, min_box=0: im
     sys.modules["pillow_heif"] = ph
 
-    # moviepy.editor.VideoFileClip
-    moviepy = types.ModuleType("moviepy")
-    moviepy.VideoFileClip = DummyVideoFileClip
-    sys.modules["moviepy"] = moviepy
+    # ffmpeg-python (ffprobe and ffmpeg are not run)
+    ffmpeg = types.ModuleType("ffmpeg")
+    ffmpeg.input = DummyStream
+    sys.modules["ffmpeg"] = ffmpeg
 
     # fitz (PyMuPDF)
     fitz = types.ModuleType("fitz")
     fitz.open = lambda path: DummyDoc(path)
+    fitz.Matrix = lambda a, b: (a, b)
     sys.modules["fitz"] = fitz
 
 
@@ -111,11 +145,13 @@ def module(tmp_path, monkeypatch, stub_deps):
     # Avoid truetype dependency on a real font file
     import PIL.ImageFont as IF
 
-    # Always use a safe bitmap font in tests
+    # Always use a safe bitmap font in tests (loaded before patching, since
+    # recent Pillow versions load the default font with ``truetype()``)
+    default_font = IF.load_default()
     monkeypatch.setattr(
         thumbnailer.ImageFont,
         "truetype",
-        lambda *_a, **_k: IF.load_default(),
+        lambda *_a, **_k: default_font,
         raising=True,
     )
 
@@ -134,6 +170,14 @@ def module(tmp_path, monkeypatch, stub_deps):
     return thumbnailer
 
 
+@pytest.fixture()
+def jobs(module):
+    # Threads share the stubs and patches of the tests.
+    queue = module.ThumbnailQueue(2, 10, executor_class=ThreadPoolExecutor)
+    yield queue
+    queue.shutdown()
+
+
 @pytest.fixture()
 def io_dirs(tmp_path):
     src = tmp_path / "in"
@@ -178,6 +222,7 @@ def test_fail_safe_decorator_catches_and_prints(module, capsys):
 
     ok(3)
     boom()
+    assert ok.__name__ == "ok"
     out = capsys.readouterr().out
     assert "boom()" in out or "boom(" in out  # prints function & args
     assert calls["ok"] == 3
@@ -216,6 +261,160 @@ def test_create_thumbnail_from_image(module, tmp_path):
 #     # We also drew a duration overlay; no easy pixel assertion, file existence suffices.
 
 
+def test_create_thumbnail_decodes_jpeg_at_reduced_scale(module, tmp_path, monkeypatch):
+    from PIL import JpegImagePlugin
+
+    src = tmp_path / "img.jpg"
+    Image.new("RGB", (4000, 3000), color=(10, 10, 10)).save(src)
+    out = tmp_path / "out" / "thumb.jpg"
+    decoded = []
+    original_convert = Image.Image.convert
+
+    def convert(img, *args, **kwargs):
+        decoded.append(img.size)
+        return original_convert(img, *args, **kwargs)
+
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, "convert", convert)
+
+    module.create_thumbnail(str(src), str(out), (256, 256), frame_time=1.0)
+
+    # DCT scaling by 1/4: 1/8 would be smaller than twice the thumbnail.
+    assert decoded == [(1000, 750)]
+    size, _ = _read_image(out)
+    assert max(size) == 256
+
+
+def jpeg_with_preview(path, size, preview_size, orientation=1):
+    """
+    Save a blue JPEG with a red preview in its EXIF (IFD1).
+    """
+    preview = io.BytesIO()
+    Image.new("RGB", preview_size, color=(200, 0, 0)).save(preview, "JPEG")
+    preview = preview.getvalue()
+    # TIFF header, IFD0 (orientation), IFD1 (preview offset and length), preview.
+    ifd1_offset = 8 + 2 + 12 + 4
+    preview_offset = ifd1_offset + 2 + 2 * 12 + 4
+    tiff = (
+        b"II*\x00"
+        + struct.pack("<I", 8)
+        + struct.pack("<HHHIHHI", 1, 0x0112, 3, 1, orientation, 0, ifd1_offset)
+        + struct.pack("<HHHII", 2, 0x0201, 4, 1, preview_offset)
+        + struct.pack("<HHII", 0x0202, 4, 1, len(preview))
+        + struct.pack("<I", 0)
+        + preview
+    )
+    Image.new("RGB", size, color=(0, 0, 200)).save(path, exif=b"Exif\x00\x00" + tiff)
+
+
+def _color(path):
+    with Image.open(path) as im:
+        return im.convert("RGB").getpixel((im.width // 2, im.height // 2))
+
+
+def test_create_thumbnail_uses_embedded_preview(module, tmp_path):
+    src = tmp_path / "img.jpg"
+    jpeg_with_preview(src, (4000, 3000), (320, 240))
+    out = tmp_path / "out" / "thumb.jpg"
+
+    module.create_thumbnail(str(src), str(out), (256, 256), frame_time=1.0)
+
+    assert _read_image(out)[0] == (256, 192)
+    red, _, blue = _color(out)
+    assert red > 150 and blue < 50
+
+
+def test_create_thumbnail_ignores_small_embedded_preview(module, tmp_path):
+    src = tmp_path / "img.jpg"
+    jpeg_with_preview(src, (4000, 3000), (160, 120))
+    out = tmp_path / "out" / "thumb.jpg"
+
+    module.create_thumbnail(str(src), str(out), (256, 256), frame_time=1.0)
+
+    assert _read_image(out)[0] == (256, 192)
+    red, _, blue = _color(out)
+    assert red < 50 and blue > 150
+
+
+def test_create_thumbnail_is_oriented(module, tmp_path):
+    src = tmp_path / "img.jpg"
+    # Rotated by 90° (orientation 6), eg. portrait photo.
+    jpeg_with_preview(src, (4000, 3000), (320, 240), orientation=6)
+    out = tmp_path / "out" / "thumb.jpg"
+
+    module.create_thumbnail(str(src), str(out), (256, 256), frame_time=1.0)
+
+    assert _read_image(out)[0] == (192, 256)
+
+
+def test_create_thumbnail_from_video_keyframe(module, tmp_path, monkeypatch):
+    src = tmp_path / "clip.mp4"
+    src.write_bytes(b"fake-video")
+    out = tmp_path / "out" / "thumb.jpg"
+    frame = io.BytesIO()
+    Image.new("RGB", (64, 36), color=(10, 20, 30)).save(frame, "BMP")
+    runs = []
+
+    def run(command, **kwargs):
+        runs.append((command, kwargs))
+        if command[0] == "ffprobe":
+            stdout = b'{"format": {"duration": "3.7"}}'
+        else:
+            stdout = frame.getvalue()
+        return subprocess.CompletedProcess(command, 0, stdout=stdout)
+
+    monkeypatch.setattr(module.subprocess, "run", run)
+
+    module.create_thumbnail(str(src), str(out), (64, 64), frame_time=1.0)
+
+    assert _read_image(out)[0] == (64, 36)
+    [(probe, probe_kwargs), (command, kwargs)] = runs
+    assert probe[-1] == str(src)
+    assert "-skip_frame" in command and "-noaccurate_seek" in command
+    assert probe_kwargs["timeout"] == kwargs["timeout"] == module.VIDEO_TIMEOUT_SECONDS
+
+
+def test_video_frame_command_built_by_ffmpeg_python(module, monkeypatch):
+    # Without the stub, to check the options that ffmpeg will receive.
+    monkeypatch.delitem(sys.modules, "ffmpeg")
+    monkeypatch.setattr(module, "ffmpeg", pytest.importorskip("ffmpeg"))
+    frame = io.BytesIO()
+    Image.new("RGB", (64, 36)).save(frame, "BMP")
+    commands = []
+
+    def run(command, **kwargs):
+        commands.append(command)
+        if command[0] == "ffprobe":
+            return subprocess.CompletedProcess(command, 0, stdout=b'{"format": {}}')
+        return subprocess.CompletedProcess(command, 0, stdout=frame.getvalue())
+
+    monkeypatch.setattr(module.subprocess, "run", run)
+
+    module.video_frame("/videos/clip.mp4", 1.0, (64, 64))
+
+    assert commands[-1] == [
+        "ffmpeg",
+        # Input options, before the input: seek to a keyframe (shorter video).
+        "-noaccurate_seek",
+        "-skip_frame",
+        "nokey",
+        "-ss",
+        "0",
+        "-i",
+        "/videos/clip.mp4",
+        "-filter_complex",
+        "[0]scale=64:64:force_original_aspect_ratio=decrease[s0]",
+        "-map",
+        "[s0]",
+        "-f",
+        "image2pipe",
+        "-vcodec",
+        "bmp",
+        "-vframes",
+        "1",
+        "pipe:",
+    ]
+
+
 def test_create_thumbnail_from_pdf_stub(module, tmp_path):
     src = tmp_path / "doc.pdf"
     src.write_bytes(b"%PDF-1.4 fake")
@@ -228,6 +427,21 @@ def test_create_thumbnail_from_pdf_stub(module, tmp_path):
     assert max(size) <= 64
 
 
+def test_create_thumbnail_renders_pdf_page_at_thumbnail_scale(
+    module, tmp_path, monkeypatch
+):
+    src = tmp_path / "poster.pdf"
+    src.write_bytes(b"%PDF-1.4 fake")
+    out = tmp_path / "out" / "thumb.jpg"
+    # A0 poster, in points.
+    monkeypatch.setattr(DummyDoc, "page_size", (2384, 3370))
+
+    module.create_thumbnail(str(src), str(out), (64, 64), frame_time=0.0)
+
+    assert _read_image(out)[0] == (45, 64)
+    assert DummyDoc.last.closed
+
+
 # def test_create_thumbnail_unknown_ext_uses_default_background(module, tmp_path):
 #     src = tmp_path / "file.xyz"
 #     src.write_bytes(b"blob")
@@ -238,19 +452,19 @@ def test_create_thumbnail_from_pdf_stub(module, tmp_path):
 #     # It drew text with extension; we won't OCR it—existence is enough.
 
 
-def test_watch_handler_on_created_directory_makes_thumb_folder(module, io_dirs):
+def test_watch_handler_on_created_directory_makes_thumb_folder(module, io_dirs, jobs):
     src, dst = io_dirs
     # create a "besace" folder
     folder = src / "oak-lime-pine"
     evt = DummyEvent(str(folder), is_directory=True)
 
-    h = module.WatchHandler(str(dst), (64, 64), 1.0, ".jpg")
+    h = module.WatchHandler(str(dst), (64, 64), 1.0, ".jpg", jobs)
     h.on_created(evt)
 
     assert (dst / "oak-lime-pine").is_dir()
 
 
-def test_watch_handler_on_created_file_creates_thumbnail(module, io_dirs):
+def test_watch_handler_on_created_file_creates_thumbnail(module, io_dirs, jobs):
     src, dst = io_dirs
     folder = src / "oak-lime-pine"
     folder.mkdir()
@@ -261,9 +475,12 @@ def test_watch_handler_on_created_file_creates_thumbnail(module, io_dirs):
     Image.new("RGB", (200, 100), color=(90, 90, 90)).save(img_path)
 
     evt = DummyEvent(str(img_path), is_directory=False)
-    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg")
-    # FILE_COMPLETE_WAIT_SECONDS is patched to 0 in fixture, so loop is instant
+    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg", jobs)
     h.on_created(evt)
+    # Nothing until the file is closed.
+    assert not jobs.pending
+    h.on_closed(evt)
+    jobs.join()
 
     out = dst / "oak-lime-pine" / "pic.png.jpg"
     assert out.is_file()
@@ -271,19 +488,102 @@ def test_watch_handler_on_created_file_creates_thumbnail(module, io_dirs):
     assert max(size) <= 40
 
 
-def test_watch_handler_ignores_non_besace_paths(module, io_dirs, capsys):
+def test_watch_handler_supports_sharded_folders(module, io_dirs, jobs, capsys):
+    src, dst = io_dirs
+    folder = src / "3f" / "a2" / "oak-lime-pine"
+    folder.mkdir(parents=True)
+    img_path = folder / "pic.png"
+    Image.new("RGB", (200, 100), color=(90, 90, 90)).save(img_path)
+
+    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg", jobs)
+    h.on_created(DummyEvent(str(src / "3f"), is_directory=True))
+    h.on_closed(DummyEvent(str(img_path), is_directory=False))
+    jobs.join()
+
+    assert "Ignore" not in capsys.readouterr().out
+    assert (dst / "oak-lime-pine" / "pic.png.jpg").is_file()
+
+
+def test_watch_handler_on_moved_file_creates_thumbnail(module, io_dirs, jobs):
+    src, dst = io_dirs
+    folder = src / "oak-lime-pine"
+    folder.mkdir()
+    img_path = folder / "pic.png"
+    Image.new("RGB", (200, 100), color=(90, 90, 90)).save(img_path)
+
+    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg", jobs)
+    h.on_moved(
+        DummyEvent(
+            str(src / ".1234.upload"), is_directory=False, dest_path=str(img_path)
+        )
+    )
+    jobs.join()
+
+    assert (dst / "oak-lime-pine" / "pic.png.jpg").is_file()
+
+
+def test_watch_handler_polls_files_that_are_not_closed(
+    module, io_dirs, jobs, monkeypatch
+):
+    src, dst = io_dirs
+    folder = src / "oak-lime-pine"
+    folder.mkdir()
+    img_path = folder / "pic.png"
+    Image.new("RGB", (200, 100), color=(90, 90, 90)).save(img_path)
+    monkeypatch.setattr(module, "FILE_COMPLETE_TIMEOUT_SECONDS", 0.01)
+
+    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg", jobs)
+    # Eg. created with a hard link.
+    h.on_created(DummyEvent(str(img_path), is_directory=False))
+
+    out = dst / "oak-lime-pine" / "pic.png.jpg"
+    deadline = time.monotonic() + 5
+    while not out.is_file() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert out.is_file()
+
+
+def test_thumbnail_jobs_are_deduplicated(module, io_dirs, monkeypatch):
+    src, dst = io_dirs
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_job(input_path, output_path, size, frame_time, poll, store):
+        calls.append(input_path)
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(module, "thumbnail_job", slow_job)
+    jobs = module.ThumbnailQueue(1, 10, executor_class=ThreadPoolExecutor)
+    jobs.submit("a.png", str(dst / "a.png.jpg"), (64, 64), 0.0)
+    started.wait(5)
+    jobs.submit("a.png", str(dst / "a.png.jpg"), (64, 64), 0.0)
+    jobs.submit("b.png", str(dst / "b.png.jpg"), (64, 64), 0.0)
+    release.set()
+    jobs.join()
+    jobs.shutdown()
+
+    assert calls == ["a.png", "b.png"]
+
+
+def test_thumbnail_jobs_can_be_sent_to_processes(module):
+    assert pickle.loads(pickle.dumps(module.thumbnail_job)) is module.thumbnail_job
+
+
+def test_watch_handler_ignores_non_besace_paths(module, io_dirs, jobs, capsys):
     src, dst = io_dirs
     bad_folder = src / "not-valid"
     evt_dir = DummyEvent(str(bad_folder), is_directory=True)
 
-    h = module.WatchHandler(str(dst), (64, 64), 1.0, ".jpg")
+    h = module.WatchHandler(str(dst), (64, 64), 1.0, ".jpg", jobs)
     h.on_created(evt_dir)
     out = capsys.readouterr().out
     assert "Ignore" in out
     assert not (dst / "not-valid").exists()
 
 
-def test_watch_handler_on_deleted_removes_thumbnail_folder(module, io_dirs):
+def test_watch_handler_on_deleted_removes_thumbnail_folder(module, io_dirs, jobs):
     src, dst = io_dirs
     folder = src / "oak-lime-pine"
     thumb_folder = dst / "oak-lime-pine"
@@ -291,12 +591,84 @@ def test_watch_handler_on_deleted_removes_thumbnail_folder(module, io_dirs):
     thumb_folder.mkdir()
 
     evt = DummyEvent(str(folder), is_directory=True)
-    h = module.WatchHandler(str(dst), (64, 64), 1.0, ".jpg")
+    h = module.WatchHandler(str(dst), (64, 64), 1.0, ".jpg", jobs)
     h.on_deleted(evt)
 
     assert not thumb_folder.exists()
 
 
+def test_watch_handler_stores_thumbnails_by_content(module, io_dirs, jobs, monkeypatch):
+    src, dst = io_dirs
+    created = []
+    create_thumbnail = module.create_thumbnail
+
+    def counting_create_thumbnail(input_path, *args):
+        created.append(os.path.basename(input_path))
+        create_thumbnail(input_path, *args)
+
+    monkeypatch.setattr(module, "create_thumbnail", counting_create_thumbnail)
+    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg", jobs)
+    for folder_name in ("oak-lime-pine", "ash-elm-fir"):
+        folder = src / folder_name
+        folder.mkdir()
+        Image.new("RGB", (200, 100), color=(90, 90, 90)).save(folder / "pic.png")
+        (folder / "notes.txt").write_text(folder_name)
+        for name in ("pic.png", "notes.txt"):
+            h.on_closed(DummyEvent(str(folder / name), is_directory=False))
+            jobs.join()
+
+    # Duplicate content and placeholders are created once, and shared.
+    assert created == ["pic.png", "notes.txt"]
+    first = dst / "oak-lime-pine" / "pic.png.jpg"
+    second = dst / "ash-elm-fir" / "pic.png.jpg"
+    assert os.path.samefile(first, second)
+    assert first.stat().st_nlink == 3
+    assert (dst / "ash-elm-fir" / "notes.txt.jpg").stat().st_nlink == 3
+
+    shutil.rmtree(src / "oak-lime-pine")
+    h.on_deleted(DummyEvent(str(src / "oak-lime-pine"), is_directory=True))
+    jobs.join()
+    assert second.stat().st_nlink == 2
+
+    shutil.rmtree(src / "ash-elm-fir")
+    h.on_deleted(DummyEvent(str(src / "ash-elm-fir"), is_directory=True))
+    jobs.join()
+    # Unused thumbnails are collected.
+    assert not [p for p in (dst / ".store").rglob("*") if p.is_file()]
+
+
+def test_stored_thumbnails_use_hashes_recorded_by_the_api(
+    module, io_dirs, jobs, monkeypatch
+):
+    src, dst = io_dirs
+    folder = src / "oak-lime-pine"
+    folder.mkdir()
+    Image.new("RGB", (200, 100), color=(90, 90, 90)).save(folder / "pic.png")
+    Image.new("RGB", (200, 100), color=(9, 9, 9)).save(folder / "old.png")
+    (src / "oak-lime-pine.md5").write_text(
+        "0123456789abcdef0123456789abcdef\n0123456789abcdef0123456789abcdef  pic.png\n"
+    )
+    hashed = []
+    file_md5 = module.file_md5
+
+    def counting_file_md5(path):
+        hashed.append(os.path.basename(path))
+        return file_md5(path)
+
+    monkeypatch.setattr(module, "file_md5", counting_file_md5)
+    h = module.WatchHandler(str(dst), (40, 40), 0.0, ".jpg", jobs)
+    for name in ("pic.png", "old.png"):
+        h.on_closed(DummyEvent(str(folder / name), is_directory=False))
+    jobs.join()
+
+    # Only files without recorded hash are read again.
+    assert hashed == ["old.png"]
+    assert (
+        dst / ".store" / "01" / "0123456789abcdef0123456789abcdef-40x40.jpg"
+    ).is_file()
+    assert (dst / "oak-lime-pine" / "old.png.jpg").is_file()
+
+
 def test_main_runs_sync_on_start_and_exits_cleanly(
     module, tmp_path, monkeypatch, capsys
 ):
@@ -322,6 +694,7 @@ def test_main_runs_sync_on_start_and_exits_cleanly(
             height=64,
             frame_time=0.0,
             extension=".jpg",
+            workers=1,
         ),
     )
     monkeypatch.setattr(module, "parse_arguments", lambda: Args, raising=True)
@@ -343,6 +716,7 @@ def test_main_runs_sync_on_start_and_exits_cleanly(
             calls["join"] += 1
 
     monkeypatch.setattr(module, "Observer", DummyObserver, raising=True)
+    monkeypatch.setattr(module, "ProcessPoolExecutor", ThreadPoolExecutor)
 
     # Make the loop exit immediately by raising KeyboardInterrupt on first sleep
     slept = {"n": 0}
@@ -353,7 +727,9 @@ def test_main_runs_sync_on_start_and_exits_cleanly(
             raise KeyboardInterrupt()
         time.sleep(0)  # pragma: no cover
 
-    monkeypatch.setattr(module, "time", types.SimpleNamespace(sleep=_sleep))
+    monkeypatch.setattr(
+        module, "time", types.SimpleNamespace(sleep=_sleep, monotonic=time.monotonic)
+    )
 
     # Run main()
     module.main()
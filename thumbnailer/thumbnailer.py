@@ -1,12 +1,21 @@
 import argparse
+import functools
+import hashlib
+import io
+import json
 import re
 import os
 import shutil
+import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
-from PIL import Image, ImageFont, ImageDraw
-from moviepy import VideoFileClip
-from pillow_heif import register_heif_opener
+import ffmpeg
+from PIL import ExifTags, Image, ImageFont, ImageDraw
+from pillow_heif import register_heif_opener, thumbnail as heif_thumbnail
 import fitz  # PyMuPDF
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
@@ -16,14 +25,56 @@ FOLDER_WORDS_COUNT = 3
 BESACE_FOLDER_PATTERN = re.compile(
     f"^([a-zA-Z]+-){{{FOLDER_WORDS_COUNT - 1}}}[a-zA-Z]+$"
 )
+# Folders may be spread in sub-directories (see `BESACE_SHARD_LEVELS` in the API),
+# thumbnails are always stored by folder name (eg. `thumbnails/ossa-teneas-doctum/`).
+SHARD_PATTERN = re.compile(r"^[0-9a-f]{2}$")
+# Files are complete when closed after writing, or moved into a folder. Files
+# that are created otherwise are polled after this delay.
+FILE_COMPLETE_TIMEOUT_SECONDS = 5
 FILE_COMPLETE_WAIT_SECONDS = 1
+# Give up polling files that keep growing (closing them will queue them again).
+FILE_POLL_TIMEOUT_SECONDS = 600
 HERE = os.path.dirname(__file__)
 DEFAULT_THUMBNAIL = os.path.join(HERE, "assets", "default.jpg")
+IMAGE_EXTENSIONS = (".heic", ".png", ".jpg", ".jpeg", ".bmp", ".gif")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+DOCUMENT_EXTENSIONS = (".pdf",)
+# Thumbnails are created once in a store shared by all folders, keyed by the
+# content of the files, and hard linked into the folders.
+STORE_FOLDER = ".store"
+PLACEHOLDERS_FOLDER = "placeholders"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Hashes recorded by the API are kept for this many folders per worker.
+FOLDERS_HASHES_CACHE_SIZE = 100
 FONT_FILE = os.path.join(HERE, "assets", "DejaVuSansCondensed-Bold.ttf")
 SYNC_ON_START = os.getenv("SYNC_ON_START", "f") in "1yY"
+# Thumbnails are created in a pool of processes, fed by a bounded queue.
+WORKERS = int(os.getenv("THUMBNAIL_WORKERS", str(os.cpu_count() or 1)))
+BACKLOG = int(os.getenv("THUMBNAIL_BACKLOG", "1000"))
+DURATION_FONT_SIZE = 16
+# Images are decoded at a reduced scale, at least this many times the thumbnail.
+DRAFT_FACTOR = 2
+# Embedded previews are used if their aspect ratio is close enough (some
+# cameras letterbox them).
+PREVIEW_RATIO_TOLERANCE = 0.02
+# ffprobe and ffmpeg are killed if they take longer (eg. truncated files).
+VIDEO_TIMEOUT_SECONDS = 60
+# Thumbnails are turned like the pictures (EXIF orientation).
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+EXTENSION_FONT_SIZE = 22
 
 
 def fail_safe(func):
+    # Wrapped functions keep their name, so that they can be sent to workers.
+    @functools.wraps(func)
     def inner_function(*args, **kwargs):
         try:
             func(*args, **kwargs)
@@ -41,6 +92,79 @@ def fail_safe(func):
     return inner_function
 
 
+@functools.cache
+def load_font(size: int):
+    return ImageFont.truetype(FONT_FILE, size)
+
+
+def embedded_preview(img: Image.Image, size: tuple[int]):
+    """
+    Return the preview embedded in the picture (EXIF or HEIF thumbnail) if it is
+    large enough for a thumbnail of ``size``, otherwise ``None``.
+    """
+    try:
+        if img.format == "HEIF":
+            preview = heif_thumbnail(img, min_box=max(size))
+            if preview is img:
+                return None
+        elif img.format == "JPEG":
+            ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+            offset = ifd1.get(ExifTags.Base.JpegIFOffset)
+            length = ifd1.get(ExifTags.Base.JpegIFByteCount)
+            if not offset or not length:
+                return None
+            # Offsets are relative to the TIFF header.
+            exif = img.info["exif"].removeprefix(b"Exif\x00\x00")
+            preview = Image.open(io.BytesIO(exif[offset : offset + length]))
+        else:
+            return None
+        width, height = img.size
+        scale = min(size[0] / width, size[1] / height, 1)
+        if preview.width < int(width * scale) or preview.height < int(height * scale):
+            return None
+        if abs(preview.width / preview.height - width / height) > (
+            PREVIEW_RATIO_TOLERANCE * width / height
+        ):
+            return None
+        return preview.convert("RGB")
+    except (OSError, SyntaxError, ValueError, KeyError) as exc:
+        # Broken previews are not worth failing for.
+        print(f"Ignore preview of {img.filename}", exc)
+        return None
+
+
+def video_frame(input_path: str, frame_time: float, size: tuple[int]):
+    """
+    Return the keyframe closest to ``frame_time`` (scaled down to ``size``) and
+    the duration of the video.
+    """
+    # Run here rather than with ffmpeg.probe(), which has no timeout.
+    probe = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_format", "-of", "json", input_path],
+        capture_output=True,
+        check=True,
+        timeout=VIDEO_TIMEOUT_SECONDS,
+    )
+    duration = float(json.loads(probe.stdout)["format"].get("duration", 0))
+    if frame_time >= duration:
+        # Shorter video.
+        frame_time = 0
+    command = (
+        # Seek to the previous keyframe, and only decode keyframes.
+        ffmpeg.input(
+            input_path, ss=frame_time, noaccurate_seek=None, skip_frame="nokey"
+        )
+        .filter("scale", size[0], size[1], force_original_aspect_ratio="decrease")
+        .output("pipe:", vframes=1, format="image2pipe", vcodec="bmp")
+        .compile()
+    )
+    # The process is waited for (or killed on timeout), even on errors.
+    result = subprocess.run(
+        command, capture_output=True, check=True, timeout=VIDEO_TIMEOUT_SECONDS
+    )
+    return Image.open(io.BytesIO(result.stdout)), duration
+
+
 @fail_safe
 def create_thumbnail(
     input_path: str, output_path: str, size: tuple[int], frame_time=float
@@ -48,20 +172,31 @@ def create_thumbnail(
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
     thumbnail_args = dict(resample=Image.Resampling.NEAREST)
-    if input_path.lower().endswith((".heic", ".png", ".jpg", ".jpeg", ".bmp", ".gif")):
+    if input_path.lower().endswith(IMAGE_EXTENSIONS):
         # Handle image input
         with Image.open(input_path) as img:
-            img_rgb = img.convert("RGB")
-            img_rgb.thumbnail(size, **thumbnail_args)
+            # pillow-heif already applies the orientation when decoding.
+            orientation = (
+                1
+                if img.format == "HEIF"
+                else img.getexif().get(ExifTags.Base.Orientation, 1)
+            )
+            box = size[::-1] if orientation in (5, 6, 7, 8) else size
+            img_rgb = embedded_preview(img, box)
+            if img_rgb is None:
+                # Let the decoder skip pixels when it can (eg. JPEG DCT scaling),
+                # instead of decoding the full resolution.
+                img.draft("RGB", (box[0] * DRAFT_FACTOR, box[1] * DRAFT_FACTOR))
+                img_rgb = img.convert("RGB")
+            img_rgb.thumbnail(box, **thumbnail_args)
+            if orientation in ORIENTATION_TRANSPOSE:
+                img_rgb = img_rgb.transpose(ORIENTATION_TRANSPOSE[orientation])
             img_rgb.save(output_path)
-    elif input_path.lower().endswith((".mp4", ".avi", ".mov", ".mkv")):
+    elif input_path.lower().endswith(VIDEO_EXTENSIONS):
         # Handle video input
-        clip = VideoFileClip(input_path)
-        frame = clip.get_frame(frame_time)
-        img = Image.fromarray(frame)
-        img.thumbnail(size, **thumbnail_args)
+        img, duration = video_frame(input_path, frame_time, size)
         # Show duration in thumbnail
-        hours, remainder = divmod(clip.duration, 3600)
+        hours, remainder = divmod(duration, 3600)
         minutes, seconds = divmod(remainder, 60)
         draw = ImageDraw.Draw(img)
         for position, color in [((6, 4), (0, 0, 0)), ((5, 3), (255, 255, 255))]:
@@ -69,17 +204,30 @@ def create_thumbnail(
                 position,
                 f"▶ {int(hours):02}:{int(minutes):02}:{int(seconds):02}",
                 color,
-                font=ImageFont.truetype(FONT_FILE, 16),
+                font=load_font(DURATION_FONT_SIZE),
             )
         img.save(output_path)
-    elif input_path.lower().endswith(".pdf"):
+    elif input_path.lower().endswith(DOCUMENT_EXTENSIONS):
         # Handle PDF input
-        doc = fitz.open(input_path)
-        page = doc.load_page(0)  # Load the first page
-        pix = page.get_pixmap()
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img.thumbnail(size, **thumbnail_args)
-        img.save(output_path)
+        with fitz.open(input_path) as doc:
+            page = doc.load_page(0)  # Load the first page
+            # Render the page straight to the thumbnail size (never larger than
+            # its default 72 dpi rendering), whatever its format.
+            scale = min(1, size[0] / page.rect.width, size[1] / page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+            # Share the pixmap buffer instead of copying it.
+            img = Image.frombuffer(
+                "RGB",
+                (pix.width, pix.height),
+                pix.samples_mv,
+                "raw",
+                "RGB",
+                pix.stride,
+                1,
+            )
+            # Rounding can exceed the size by one pixel.
+            img.thumbnail(size, **thumbnail_args)
+            img.save(output_path)
     else:
         print(f"Unsupported file format: {input_path}")
         # Show extension in thumbnail
@@ -88,13 +236,267 @@ def create_thumbnail(
             # Make a writable, consistent-mode image (avoids read-only/lazy issues)
             img = base.convert("RGB").copy()
         draw = ImageDraw.Draw(img)
-        font = ImageFont.truetype(FONT_FILE, 22)
+        font = load_font(EXTENSION_FONT_SIZE)
         draw.text((33, 33), ext, (105, 115, 125), font=font)
         img.save(output_path)
 
     print(f"Thumbnail saved as {output_path}")
 
 
+def file_md5(path: str):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+# Per worker: ``{md5file: (offset, {filename: md5})}``, least recent first.
+folders_hashes: dict[str, tuple[int, dict[str, str]]] = {}
+
+
+def recorded_md5(input_path: str):
+    """
+    Return the MD5 of the file recorded by the API when it was uploaded (lines
+    ``md5  filename`` of the ``{folder}.md5`` file), or ``None``.
+
+    Only the lines appended since the last call are read.
+    """
+    folder_dir, filename = os.path.split(input_path)
+    md5file = folder_dir + ".md5"
+    offset, hashes = folders_hashes.pop(md5file, (0, {}))
+    try:
+        size = os.path.getsize(md5file)
+    except FileNotFoundError:
+        # Uploaded before hashes were recorded, or folder being migrated.
+        return None
+    if size < offset:
+        # File was recreated.
+        offset, hashes = 0, {}
+    if size > offset:
+        with open(md5file, "rb") as f:
+            f.seek(offset)
+            content = f.read(size - offset)
+        # Ignore a line that is being written.
+        content = content[: content.rfind(b"\n") + 1]
+        for line in content.decode().splitlines():
+            md5hash, _, name = line.partition("  ")
+            if name:
+                hashes[name] = md5hash
+        offset += len(content)
+    folders_hashes[md5file] = (offset, hashes)
+    while len(folders_hashes) > FOLDERS_HASHES_CACHE_SIZE:
+        del folders_hashes[next(iter(folders_hashes))]
+    return hashes.get(filename)
+
+
+def stored_thumbnail_path(
+    store: str, input_path: str, output_path: str, size: tuple[int]
+):
+    """
+    Return the path of the thumbnail in the store: by MD5 (recorded by the API,
+    or computed for other files) and size, or by extension for the placeholders
+    of unsupported files.
+    """
+    _, extension = os.path.splitext(output_path)
+    if input_path.lower().endswith(
+        IMAGE_EXTENSIONS + VIDEO_EXTENSIONS + DOCUMENT_EXTENSIONS
+    ):
+        md5hash = recorded_md5(input_path) or file_md5(input_path)
+        name = f"{md5hash}-{size[0]}x{size[1]}{extension}"
+        return os.path.join(store, md5hash[:2], name)
+    _, input_extension = os.path.splitext(input_path)
+    return os.path.join(
+        store, PLACEHOLDERS_FOLDER, f"placeholder{input_extension}{extension}"
+    )
+
+
+def store_thumbnail(
+    store: str, input_path: str, output_path: str, size: tuple[int], frame_time: float
+):
+    """
+    Create the thumbnail in the store if missing, and hard link it to
+    ``output_path``. Files with the same content are only decoded once.
+    """
+    stored_path = stored_thumbnail_path(store, input_path, output_path, size)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    for _ in range(2):
+        if not os.path.exists(stored_path):
+            # Written aside and renamed, to never link a partial thumbnail.
+            os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+            _, extension = os.path.splitext(stored_path)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(stored_path), prefix=".", suffix=extension
+            )
+            os.close(fd)
+            try:
+                create_thumbnail(input_path, tmp_path, size, frame_time)
+                if os.path.getsize(tmp_path) == 0:
+                    # Error was printed.
+                    return
+                os.replace(tmp_path, stored_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        try:
+            os.link(stored_path, output_path)
+        except FileExistsError:
+            # Already created (eg. by the API).
+            pass
+        except FileNotFoundError:
+            # Collected meanwhile, create it again.
+            continue
+        print(f"Thumbnail linked as {output_path}")
+        return
+
+
+@fail_safe
+def collect_thumbnails(store: str):
+    """
+    Delete the thumbnails of the store that are not linked into any folder
+    anymore (eg. when folders are deleted).
+    """
+    try:
+        shards = list(os.scandir(store))
+    except FileNotFoundError:
+        # No thumbnail created yet.
+        return
+    removed = 0
+    for shard in shards:
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            # Files being created start with a dot.
+            if entry.name.startswith("."):
+                continue
+            if entry.stat().st_nlink == 1:
+                os.remove(entry.path)
+                removed += 1
+    print(f"Removed {removed} unused thumbnails from {store}")
+
+
+def wait_until_complete(path: str) -> bool:
+    """
+    Wait for the size of the file to settle, and return ``False`` on timeout.
+    """
+    deadline = time.monotonic() + FILE_POLL_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        size_before = os.path.getsize(path)
+        time.sleep(FILE_COMPLETE_WAIT_SECONDS)
+        size_now = os.path.getsize(path)
+        if size_now == size_before:
+            return True
+    return False
+
+
+@fail_safe
+def init_worker():
+    """
+    Prepare a worker once for all its jobs.
+    """
+    register_heif_opener()
+    load_font(DURATION_FONT_SIZE)
+    load_font(EXTENSION_FONT_SIZE)
+
+
+@fail_safe
+def thumbnail_job(
+    input_path: str,
+    output_path: str,
+    size: tuple[int],
+    frame_time: float,
+    poll: bool = False,
+    store: str | None = None,
+):
+    if poll and not wait_until_complete(input_path):
+        print(f"File {input_path} is still being written")
+        return
+    if store is None:
+        create_thumbnail(input_path, output_path, size, frame_time)
+    else:
+        store_thumbnail(store, input_path, output_path, size, frame_time)
+
+
+class ThumbnailQueue:
+    """
+    Create thumbnails in a pool of ``workers`` processes.
+
+    A thumbnail that is already queued is not queued again, and ``submit()``
+    blocks while ``backlog`` jobs are waiting for a worker.
+    """
+
+    def __init__(self, workers: int, backlog: int, executor_class=None):
+        self.workers = workers
+        self.executor_class = executor_class or ProcessPoolExecutor
+        self.executor = self.new_executor()
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+        self.pending = {}
+        self.mutex = threading.Lock()
+        self.closed = False
+
+    def new_executor(self):
+        return self.executor_class(max_workers=self.workers, initializer=init_worker)
+
+    def submit(
+        self,
+        input_path: str,
+        output_path: str,
+        size: tuple[int],
+        frame_time: float,
+        poll: bool = False,
+        store: str | None = None,
+    ):
+        """
+        Queue the creation of a thumbnail. With ``poll``, the worker waits for
+        the file to be complete first. With ``store``, it is created in (or
+        linked from) the thumbnails store.
+        """
+        args = (input_path, output_path, size, frame_time, poll, store)
+        self.schedule(output_path, thumbnail_job, *args)
+
+    def collect(self, store: str):
+        """
+        Queue the deletion of the unused thumbnails of the store.
+        """
+        self.schedule(store, collect_thumbnails, store)
+
+    def schedule(self, key: str, func, *args):
+        if self.closed or key in self.pending:
+            return
+        self.slots.acquire()
+        with self.mutex:
+            if key in self.pending:
+                self.slots.release()
+                return
+            try:
+                future = self.executor.submit(func, *args)
+            except BrokenProcessPool:
+                # A worker died (eg. out of memory), start a new pool.
+                print("Restart broken workers pool")
+                self.executor = self.new_executor()
+                future = self.executor.submit(func, *args)
+            self.pending[key] = future
+        future.add_done_callback(functools.partial(self.done, key))
+
+    def done(self, key, future):
+        with self.mutex:
+            self.pending.pop(key, None)
+        self.slots.release()
+        if not future.cancelled() and (exc := future.exception()) is not None:
+            print(f"Could not complete job {key}", exc)
+
+    def join(self):
+        """
+        Wait for the queued jobs to be done.
+        """
+        while futures := list(self.pending.values()):
+            wait(futures)
+
+    def shutdown(self):
+        self.closed = True
+        self.executor.shutdown(wait=True)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description="Create thumbnails of image, video, or PDF files."
@@ -118,53 +520,115 @@ def parse_arguments():
         default=".jpg",
         help="Thumbnail file extension (default is '.jpg')",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of processes creating thumbnails (default is one per CPU)",
+    )
     return parser.parse_args()
 
 
 class WatchHandler(FileSystemEventHandler):
     def __init__(
-        self, output_path: str, size: tuple[int], frame_time: float, extension: str
+        self,
+        output_path: str,
+        size: tuple[int],
+        frame_time: float,
+        extension: str,
+        jobs: ThumbnailQueue,
     ):
         super().__init__()
         self.output_path = output_path
         self.size = size
         self.frame_time = frame_time
         self.extension = extension
+        self.jobs = jobs
+        self.store = os.path.join(output_path, STORE_FOLDER)
+        # Created files that were not closed nor moved yet, with their deadline.
+        self.incomplete: dict[str, float] = {}
+        self.incomplete_changed = threading.Condition()
+        threading.Thread(target=self.poll_incomplete, daemon=True).start()
+
+    def thumbnail_path(self, path: str):
+        """
+        Return the path of the thumbnail of the file, or ``None`` if it is not
+        in a besace folder.
+        """
+        folder_name = os.path.basename(os.path.dirname(path))
+        if not BESACE_FOLDER_PATTERN.match(folder_name):
+            print(f"Ignore {path}")
+            return None
+        file_name = os.path.basename(path)
+        return os.path.join(self.output_path, folder_name, file_name) + self.extension
+
+    def queue(self, path: str, poll: bool = False):
+        if (output_path := self.thumbnail_path(path)) is None:
+            return
+        self.jobs.submit(
+            path, output_path, self.size, self.frame_time, poll=poll, store=self.store
+        )
+
+    def poll_incomplete(self):
+        """
+        Queue the files that were not closed in time, to be polled by workers
+        (eg. created with a hard link, or written for long).
+        """
+        while not self.jobs.closed:
+            with self.incomplete_changed:
+                now = time.monotonic()
+                expired = [p for p, d in self.incomplete.items() if d <= now]
+                for path in expired:
+                    del self.incomplete[path]
+                if not expired:
+                    timeout = min(self.incomplete.values(), default=now + 3600) - now
+                    self.incomplete_changed.wait(timeout)
+            for path in expired:
+                self.queue(path, poll=True)
+
+    def complete(self, path: str):
+        with self.incomplete_changed:
+            self.incomplete.pop(path, None)
+        self.queue(path)
 
     def on_created(self, event):
         """
-        Create thumbnails folders and images.
+        Create thumbnails folders, and wait for new files to be complete.
         """
         if event.is_directory:
             folder_name = os.path.basename(event.src_path)
+            if SHARD_PATTERN.match(folder_name):
+                return
             if not BESACE_FOLDER_PATTERN.match(folder_name):
                 print(f"Ignore {event.src_path}")
                 return
             print(f"New besace folder created: {event.src_path}")
-            os.makedirs(os.path.join(self.output_path, folder_name))
+            os.makedirs(os.path.join(self.output_path, folder_name), exist_ok=True)
         else:
-            parent_folder = os.path.dirname(event.src_path)
-            folder_name = os.path.basename(parent_folder)
-            file_name = os.path.basename(event.src_path)
-            if not BESACE_FOLDER_PATTERN.match(folder_name):
-                print(f"Ignore {event.src_path}")
+            if self.thumbnail_path(event.src_path) is None:
                 return
-            # Wait for file to be fully written.
-            while True:
-                size_before = os.path.getsize(event.src_path)
-                time.sleep(FILE_COMPLETE_WAIT_SECONDS)
-                size_now = os.path.getsize(event.src_path)
-                if size_now == size_before:
-                    break
-            # Now create the thumbnail.
             print(f"New file created: {event.src_path}")
-            output_path = os.path.join(self.output_path, folder_name, file_name)
-            create_thumbnail(
-                event.src_path,
-                f"{output_path}{self.extension}",
-                self.size,
-                self.frame_time,
-            )
+            with self.incomplete_changed:
+                self.incomplete[event.src_path] = (
+                    time.monotonic() + FILE_COMPLETE_TIMEOUT_SECONDS
+                )
+                self.incomplete_changed.notify()
+
+    def on_closed(self, event):
+        """
+        Create the thumbnail of a file once written.
+        """
+        if not event.is_directory:
+            self.complete(event.src_path)
+
+    def on_moved(self, event):
+        """
+        Create the thumbnail of a file moved into a folder (eg. finished uploads).
+        """
+        if not event.is_directory:
+            with self.incomplete_changed:
+                self.incomplete.pop(event.src_path, None)
+            self.complete(event.dest_path)
 
     def on_deleted(self, event):
         """
@@ -182,13 +646,14 @@ class WatchHandler(FileSystemEventHandler):
             except FileNotFoundError:
                 # Already deleted or never created.
                 pass
+            self.jobs.collect(self.store)
 
 
 def main():
-    register_heif_opener()
-
     args = parse_arguments()
     size = (args.width, args.height)
+    jobs = ThumbnailQueue(args.workers, BACKLOG)
+    store = os.path.join(args.output, STORE_FOLDER)
 
     if SYNC_ON_START:
         print("Sync on startup...")
@@ -203,12 +668,16 @@ def main():
                 )
                 if os.path.exists(output_path):
                     continue
-                create_thumbnail(input_path, output_path, size, args.frame_time)
+                jobs.submit(input_path, output_path, size, args.frame_time, store=store)
+        # Folders may have been deleted meanwhile.
+        jobs.collect(store)
 
     print(f"Watching {args.input}, thumbnails in {args.output}")
     observer = Observer()
 
-    event_handler = WatchHandler(args.output, size, args.frame_time, args.extension)
+    event_handler = WatchHandler(
+        args.output, size, args.frame_time, args.extension, jobs
+    )
     observer.schedule(event_handler, args.input, recursive=True)
     observer.start()
 
@@ -218,6 +687,7 @@ def main():
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    jobs.shutdown()
 
 
 if __name__ == "__main__":